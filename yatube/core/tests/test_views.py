@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+from http import HTTPStatus
+
+from django.conf import settings
+from django.test import Client, TestCase, override_settings
+from django.utils.http import http_date
+
+
+TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class MediaViewTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.guest_client = Client()
+        os.makedirs(os.path.join(TEMP_MEDIA_ROOT, 'posts', 'ab'))
+        cls.image_path = os.path.join(TEMP_MEDIA_ROOT, 'posts', 'ab', 'a.jpg')
+        with open(cls.image_path, 'wb') as image:
+            image.write(b'jpeg bytes')
+        os.makedirs(os.path.join(TEMP_MEDIA_ROOT, 'cache'))
+        with open(os.path.join(TEMP_MEDIA_ROOT, 'cache', 'kv.sqlite3'),
+                  'wb') as private:
+            private.write(b'private')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def test_file_response(self):
+        """без веб-сервера файл отдается самим Django с кэшированием"""
+        response = self.guest_client.get('/media/posts/ab/a.jpg')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(b''.join(response.streaming_content), b'jpeg bytes')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    @override_settings(MEDIA_SERVE_MODE='x-accel-redirect')
+    def test_x_accel_redirect(self):
+        """для nginx отдается только заголовок X-Accel-Redirect"""
+        response = self.guest_client.get('/media/posts/ab/a.jpg')
+        self.assertEqual(
+            response['X-Accel-Redirect'], '/protected-media/posts/ab/a.jpg')
+        self.assertEqual(response.content, b'')
+
+    @override_settings(MEDIA_SERVE_MODE='x-sendfile')
+    def test_x_sendfile(self):
+        """для Apache отдается путь к файлу в X-Sendfile"""
+        response = self.guest_client.get('/media/posts/ab/a.jpg')
+        self.assertEqual(response['X-Sendfile'], self.image_path)
+
+    def test_not_modified(self):
+        """неизменившийся файл не отдается повторно"""
+        response = self.guest_client.get(
+            '/media/posts/ab/a.jpg',
+            HTTP_IF_MODIFIED_SINCE=http_date(
+                os.path.getmtime(self.image_path)))
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+    def test_private_and_missing_files(self):
+        """служебные, несуществующие и чужие файлы недоступны"""
+        for url in ('/media/cache/kv.sqlite3', '/media/posts/ab/b.jpg',
+                    '/media/posts/../../manage.py'):
+            with self.subTest(url=url):
+                response = self.guest_client.get(url)
+                self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
@@ -1,4 +1,20 @@
+import mimetypes
+import os
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.http import HttpResponseNotModified
 from django.shortcuts import render
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+
+# Имена в MEDIA_ROOT содержат хэш содержимого, поэтому файл по одному
+# адресу никогда не меняется и его можно кэшировать навсегда.
+MEDIA_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MEDIA_EXTENSIONS = ('.gif', '.jpeg', '.jpg', '.png', '.webp')
 
 
 def page_not_found(request, exception):
@@ -11,3 +27,44 @@ def server_failure(request):
 
 def csrf_failure(request, reason=''):
     return render(request, 'core/403csrf.html')
+
+
+def media(request, path):
+    """Отдает файл из MEDIA_ROOT.
+
+    Django только проверяет доступ, а байты отдает веб-сервер перед ним
+    (X-Accel-Redirect для nginx, X-Sendfile для Apache и lighttpd). Без
+    него файл отдается через FileResponse, который использует
+    wsgi.file_wrapper (sendfile), если сервер его поддерживает.
+    """
+    # Открыты только картинки постов и их превью; служебные файлы
+    # (например, KV-хранилище превью) наружу не отдаются.
+    if (not path.startswith(tuple(settings.MEDIA_PUBLIC_PREFIXES))
+            or not path.lower().endswith(MEDIA_EXTENSIONS)):
+        raise Http404
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, ValueError, OSError):
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    if not was_modified_since(
+            request.META.get('HTTP_IF_MODIFIED_SINCE'),
+            stat.st_mtime, stat.st_size):
+        response = HttpResponseNotModified()
+    elif settings.MEDIA_SERVE_MODE == 'x-accel-redirect':
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + path
+    elif settings.MEDIA_SERVE_MODE == 'x-sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = full_path
+    else:
+        response = FileResponse(open(full_path, 'rb'))
+    content_type, encoding = mimetypes.guess_type(full_path)
+    response['Content-Type'] = content_type or 'application/octet-stream'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = MEDIA_CACHE_CONTROL
+    return response
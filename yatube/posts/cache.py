@@ -0,0 +1,166 @@
+"""Версионированные ключи кэша лент и страниц.
+
+У каждой ленты (общей, группы, автора) есть счётчик поколения. Он входит
+в ключ фрагментного кэша и увеличивается при любом изменении постов этой
+ленты, поэтому кэш можно держать долго: после записи старые фрагменты
+просто перестают запрашиваться и вытесняются сами.
+
+Те же счётчики (плюс счётчики отдельных постов и пользователей) проверяет
+полностраничный кэш для анонимных посетителей: страница помнит поколения
+всего, что на ней показано, и отдается из кэша, только пока они не менялись.
+
+Отрисованные карточки постов кэшируются отдельно, под версией самого поста
+(etag), поэтому после сброса поколения ленты страница собирается из
+готовых карточек и заново рисует только изменившиеся.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.core.cache import cache
+
+
+FEED_CACHE_TIMEOUT = 60 * 60
+PAGE_CACHE_TIMEOUT = 60 * 10
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+PAGE_CACHE_HEADER = 'X-Page-Cache'
+GLOBAL_SCOPE = 'global'
+
+
+def group_scope(group_id):
+    return f'group:{group_id}'
+
+
+def author_scope(author_id):
+    return f'author:{author_id}'
+
+
+def post_scope(post_id):
+    return f'post:{post_id}'
+
+
+def user_scope(user_id):
+    return f'user:{user_id}'
+
+
+def card_key(post, *variant):
+    """Ключ отрисованной карточки поста.
+
+    Кроме версии поста в ключ входит то, что карточка берет у автора и
+    группы: их изменения не трогают etag.
+    """
+    author = post.author
+    shown = '\n'.join((
+        author.username, author.first_name, author.last_name,
+        post.group.slug if post.group_id else '',
+    ))
+    digest = hashlib.md5(shown.encode()).hexdigest()
+    return ':'.join(map(str, ('card', post.pk, post.etag, digest, *variant)))
+
+
+def _key(scope):
+    return f'generation:{scope}'
+
+
+def _initial():
+    # Если счётчик вытеснили, новое значение должно быть больше любого
+    # прежнего, иначе оживут устаревшие фрагменты.
+    return int(time.time() * 1000)
+
+
+def get_generation(scope):
+    generation = cache.get(_key(scope))
+    if generation is None:
+        cache.add(_key(scope), _initial(), None)
+        generation = cache.get(_key(scope), _initial())
+    return generation
+
+
+def bump_generations(*scopes):
+    for scope in set(scopes):
+        try:
+            cache.incr(_key(scope))
+        except ValueError:
+            cache.set(_key(scope), _initial(), None)
+
+
+def post_scopes(post, *group_ids):
+    """Ленты, в которых виден пост (и его прежние группы)."""
+    scopes = [GLOBAL_SCOPE, author_scope(post.author_id)]
+    for group_id in (post.group_id, *group_ids):
+        if group_id is not None:
+            scopes.append(group_scope(group_id))
+    return scopes
+
+
+def feed_cache_context(scope):
+    """Переменные шаблона для фрагментного кэша ленты."""
+    return {
+        'feed_cache_timeout': FEED_CACHE_TIMEOUT,
+        'feed_generation': get_generation(scope),
+    }
+
+
+def depend_on(request, *scopes):
+    """Отмечает, от чего зависит страница в полностраничном кэше."""
+    generations = getattr(request, 'page_cache_generations', None)
+    if generations is None:
+        return
+    for scope in scopes:
+        if scope not in generations:
+            generations[scope] = get_generation(scope)
+
+
+def depend_on_comments(request, comments):
+    """Страница показывает имена авторов комментариев."""
+    depend_on(request, *(
+        user_scope(comment.author_id) for comment in comments))
+
+
+def depend_on_posts(request, posts):
+    """Страница показывает карточки постов со ссылками на их группы."""
+    depend_on(request, *(
+        group_scope(post.group_id) for post in posts
+        if post.group_id is not None
+    ))
+
+
+def _is_fresh(generations):
+    current = cache.get_many([_key(scope) for scope in generations])
+    return all(
+        current.get(_key(scope)) == generation
+        for scope, generation in generations.items()
+    )
+
+
+def cache_page_for_anonymous(view):
+    """Кэширует ответ целиком для неавторизованных GET-запросов.
+
+    Ключ — путь с query string. Ответ отдается из кэша, пока не изменилось
+    ни одно поколение, отмеченное представлением через depend_on().
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if (request.method not in ('GET', 'HEAD')
+                or request.user.is_authenticated):
+            response = view(request, *args, **kwargs)
+            response[PAGE_CACHE_HEADER] = 'BYPASS'
+            return response
+        key = 'page:' + hashlib.md5(
+            request.get_full_path().encode()).hexdigest()
+        cached = cache.get(key)
+        if cached is not None and _is_fresh(cached[0]):
+            response = cached[1]
+            response[PAGE_CACHE_HEADER] = 'HIT'
+            return response
+        request.page_cache_generations = {}
+        response = view(request, *args, **kwargs)
+        response[PAGE_CACHE_HEADER] = 'MISS'
+        if response.status_code == 200 and request.page_cache_generations:
+            cache.set(
+                key,
+                (request.page_cache_generations, response),
+                PAGE_CACHE_TIMEOUT,
+            )
+        return response
+    return wrapper
@@ -0,0 +1,117 @@
+"""Поддержка денормализованных счётчиков.
+
+Счётчики меняются атомарным UPDATE ... SET x = x + 1, поэтому страницы
+профиля и поста читают их без COUNT(*). Если строки со счётчиками нет,
+она пересчитывается с нуля; recount_* чинят счётчики массово.
+
+Число постов в ленте для пагинатора по номерам берётся из кэша (ключ
+содержит поколение ленты, поэтому после записи считается заново), а для
+очень большой общей ленты — оценивается по максимальному pk.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count, F, IntegerField, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .cache import FEED_CACHE_TIMEOUT, get_generation
+from .models import Comment, Follow, Post, UserStats
+
+
+User = get_user_model()
+DEFAULT_ESTIMATE_THRESHOLD = 100_000
+
+
+def _count(queryset, field):
+    """Подзапрос с числом строк queryset для OuterRef('pk')."""
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{field: OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(total=Count('pk'))
+            .values('total'),
+            output_field=IntegerField(),
+        ),
+        0,
+    )
+
+
+def recount_users(user_ids=None):
+    """Пересчитывает счётчики пользователей; None — всех."""
+    users = User.objects.all()
+    if user_ids is not None:
+        users = users.filter(pk__in=user_ids)
+    UserStats.objects.bulk_create(
+        (UserStats(user_id=pk) for pk in users.values_list('pk', flat=True)),
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+    stats = UserStats.objects.all()
+    if user_ids is not None:
+        stats = stats.filter(pk__in=user_ids)
+    return stats.update(
+        posts_count=_count(Post.objects, 'author'),
+        followers_count=_count(Follow.objects, 'author'),
+        following_count=_count(Follow.objects, 'user'),
+    )
+
+
+def recount_posts():
+    """Пересчитывает число комментариев у всех постов."""
+    return Post.objects.update(
+        comments_count=_count(Comment.objects, 'post'))
+
+
+def _change(queryset, field, delta):
+    if delta < 0:
+        queryset = queryset.filter(**{field + '__gte': -delta})
+    return queryset.update(**{field: F(field) + delta})
+
+
+def change_user_counter(user_id, field, delta):
+    updated = _change(
+        UserStats.objects.filter(user_id=user_id), field, delta)
+    # Уменьшение без строки бывает при каскадном удалении пользователя:
+    # создавать для него счётчики нельзя.
+    if not updated and delta > 0:
+        recount_users([user_id])
+
+
+def change_comments_counter(post_id, delta):
+    _change(Post.objects.filter(pk=post_id), 'comments_count', delta)
+
+
+def get_stats(user):
+    """Счётчики пользователя, при отсутствии — пересчитанные."""
+    try:
+        return user.stats
+    except UserStats.DoesNotExist:
+        recount_users([user.pk])
+        return UserStats.objects.get(user=user)
+
+
+def _estimate(queryset):
+    """Оценка числа строк без фильтров по максимальному pk (или None).
+
+    Используется, только если оценка не меньше порога: на больших таблицах
+    неточность в пару удалённых постов незаметна, а COUNT(*) дорог.
+    """
+    if queryset.query.where:
+        return None
+    estimate = queryset.order_by().aggregate(top=Max('pk'))['top'] or 0
+    threshold = getattr(
+        settings, 'PAGINATOR_ESTIMATE_THRESHOLD', DEFAULT_ESTIMATE_THRESHOLD)
+    return estimate if estimate >= threshold else None
+
+
+def feed_count(queryset, scope):
+    """Число постов ленты scope без COUNT(*) на каждый запрос."""
+    key = f'count:{scope}:{get_generation(scope)}'
+    count = cache.get(key)
+    if count is None:
+        count = _estimate(queryset)
+        if count is None:
+            count = queryset.count()
+        cache.set(key, count, FEED_CACHE_TIMEOUT)
+    return count
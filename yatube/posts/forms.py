@@ -1,6 +1,8 @@
 from django import forms
+from django.core.files.uploadedfile import UploadedFile
 
 from .models import Post, Comment
+from .uploads import check_image, check_size, max_bytes, strip_upload
 
 
 class PostForm(forms.ModelForm):
@@ -8,6 +10,28 @@ class PostForm(forms.ModelForm):
         model = Post
         fields = ('text', 'group', 'image')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Файл сверх лимита обрезан при приёме, и ImageField счёл бы его
+        # повреждённым. Он не доходит до разбора картинки: clean_image
+        # сразу сообщает о размере.
+        self.oversized = None
+        name = self.add_prefix('image')
+        upload = self.files.get(name)
+        if isinstance(upload, UploadedFile) and upload.size > max_bytes():
+            self.files = self.files.copy()
+            del self.files[name]
+            self.oversized = upload
+
+    def clean_image(self):
+        if self.oversized is not None:
+            check_size(self.oversized)
+        image = self.cleaned_data['image']
+        if isinstance(image, UploadedFile):
+            check_image(image)
+            strip_upload(image)
+        return image
+
 
 class CommentForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,126 @@
+"""Сборка мусора в MEDIA_ROOT.
+
+Оригиналы картинок, на которые не ссылается ни один пост, и превью, о
+которых не знает KV-хранилище sorl-thumbnail, удаляются или переносятся
+в карантин. Каталоги обходятся потоково (os.scandir), а проверка ссылок
+идёт пачками, поэтому память ограничена размером пачки, а не числом
+файлов.
+
+Свежие файлы не трогаются: картинка сохраняется на диск раньше, чем
+пост с ней попадает в базу.
+"""
+import os
+import posixpath
+import re
+import shutil
+import time
+from collections import Counter
+from itertools import islice
+
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings as thumbnail_settings
+from sorl.thumbnail.images import ImageFile
+
+from .images import delete_with_thumbnails, source
+from .models import Post, StoredImage
+from .thumbnails import cached_thumbnails
+
+
+DEFAULT_BATCH = 1000
+DEFAULT_MIN_AGE = 60 * 60 * 24
+# Имена превью sorl-thumbnail: md5 в шестнадцатеричном виде. Остальные
+# файлы в каталоге превью (например, KV-хранилище) не трогаем.
+THUMBNAIL_NAME = re.compile(r'[0-9a-f]{32}\.\w+')
+
+
+def walk(root, prefix=''):
+    """Файлы каталога рекурсивно: (имя относительно MEDIA_ROOT, DirEntry)."""
+    try:
+        entries = os.scandir(root)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            name = posixpath.join(prefix, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk(entry.path, name)
+            elif entry.is_file(follow_symlinks=False):
+                yield name, entry
+
+
+def _batches(files, size, min_age):
+    deadline = time.time() - min_age
+    files = (
+        (name, entry) for name, entry in files
+        if entry.stat().st_mtime < deadline
+    )
+    while True:
+        batch = dict(islice(files, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Collector:
+    """Ищет и убирает мусор; dry_run только считает."""
+
+    def __init__(self, batch=DEFAULT_BATCH, min_age=DEFAULT_MIN_AGE,
+                 quarantine=None, dry_run=False):
+        self.batch = batch
+        self.min_age = min_age
+        self.quarantine = quarantine
+        self.dry_run = dry_run
+        self.stats = Counter()
+
+    def _discard(self, storage, name, entry, kind):
+        self.stats[f'{kind}_files'] += 1
+        self.stats[f'{kind}_bytes'] += entry.stat().st_size
+        if self.dry_run:
+            return
+        if self.quarantine is None:
+            storage.delete(name)
+            return
+        target = os.path.join(self.quarantine, *name.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(entry.path, target)
+
+    def collect_originals(self):
+        """Оригиналы, на которые не ссылается ни один пост."""
+        storage = Post.image.field.storage
+        upload_to = Post.image.field.upload_to.rstrip('/')
+        files = walk(storage.path(upload_to), upload_to)
+        for batch in _batches(files, self.batch, self.min_age):
+            referenced = set(
+                Post.objects.filter(image__in=list(batch))
+                .values_list('image', flat=True))
+            orphans = [name for name in batch if name not in referenced]
+            for name in orphans:
+                if not self.dry_run:
+                    # Превью оригинала больше не нужны: убираем их вместе
+                    # с записями в KV-хранилище.
+                    delete_with_thumbnails(source(name), delete_file=False)
+                self._discard(storage, name, batch[name], 'originals')
+            if orphans and not self.dry_run:
+                StoredImage.objects.filter(name__in=orphans).delete()
+
+    def collect_thumbnails(self):
+        """Превью, которых нет в KV-хранилище sorl-thumbnail."""
+        storage = default.storage
+        prefix = thumbnail_settings.THUMBNAIL_PREFIX.rstrip('/')
+        files = (
+            (name, entry) for name, entry in walk(storage.path(prefix), prefix)
+            if THUMBNAIL_NAME.fullmatch(entry.name)
+        )
+        for batch in _batches(files, self.batch, self.min_age):
+            thumbnails = [ImageFile(name, storage) for name in batch]
+            known = cached_thumbnails(thumbnails)
+            for thumbnail in thumbnails:
+                if thumbnail.key not in known:
+                    self._discard(
+                        storage, thumbnail.name, batch[thumbnail.name],
+                        'thumbnails')
+
+    def collect(self):
+        self.collect_originals()
+        self.collect_thumbnails()
+        return self.stats
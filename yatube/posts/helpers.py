@@ -1,11 +1,205 @@
-from django.core.paginator import Paginator
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Page, Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
 
 
 POSTS_PER_PAGE = 10
+FEED_ORDERING = ('-pub_date', '-pk')
+CURSOR_PARAM = 'cursor'
+COMMENTS_PER_PAGE = 20
+COMMENT_ORDERING = ('-pub_date', '-pk')
+# На странице поста курсор комментариев свой, чтобы не путать его
+# с курсором лент.
+COMMENTS_CURSOR_PARAM = 'comments'
+# Навигация по номерам показывает края и окно вокруг текущей страницы.
+PAGE_RANGE_ON_EACH_SIDE = 2
+PAGE_RANGE_ON_ENDS = 1
+
+
+class CursorPaginator(Paginator):
+    """Keyset-пагинатор: страница выбирается условием по ключу сортировки.
+
+    Вместо OFFSET и COUNT(*) строится условие «строго после последней
+    записи предыдущей страницы», поэтому глубокие страницы стоят столько же,
+    сколько первая. Общего числа записей пагинатор не знает: count и
+    num_pages после get_cursor_page() описывают только текущую страницу
+    и её соседей.
+    """
+
+    def __init__(self, object_list, per_page, ordering=FEED_ORDERING):
+        super().__init__(object_list, per_page)
+        self.ordering = ordering
+        self.model = object_list.model
+
+    def _field(self, name):
+        if name == 'pk':
+            return self.model._meta.pk
+        return self.model._meta.get_field(name)
+
+    def _key(self, obj):
+        return [
+            self._field(field.lstrip('-')).value_to_string(obj)
+            for field in self.ordering
+        ]
+
+    def encode_cursor(self, obj, direction):
+        raw = json.dumps([direction] + self._key(obj))
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """Возвращает (направление, значения ключа) или None."""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            direction, *values = json.loads(
+                base64.urlsafe_b64decode(padded.encode()).decode())
+            # encode_cursor() пишет значения ключа строками; null и прочее
+            # из самодельного курсора до запроса не доходит.
+            if (direction not in ('next', 'prev')
+                    or len(values) != len(self.ordering)
+                    or not all(isinstance(value, str) for value in values)):
+                return None
+            values = [
+                self._field(field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except (ValueError, TypeError, UnicodeDecodeError, ValidationError):
+            return None
+        return direction, values
+
+    def _seek(self, values, reverse):
+        """Условие «после ключа» для лексикографического порядка."""
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            descending = field.startswith('-') != reverse
+            lookup = '%s__%s' % (name, 'lt' if descending else 'gt')
+            condition |= Q(**equal, **{lookup: value})
+            equal[name] = value
+        return condition
+
+    def get_cursor_page(self, cursor):
+        """Страница по курсору; битый курсор ведет на первую страницу."""
+        decoded = self.decode_cursor(cursor) if cursor else None
+        queryset = self.object_list
+        reverse = False
+        if decoded is None:
+            cursor = ''
+            queryset = queryset.order_by(*self.ordering)
+        else:
+            direction, values = decoded
+            reverse = direction == 'prev'
+            ordering = self.ordering
+            if reverse:
+                ordering = [
+                    field[1:] if field.startswith('-') else '-' + field
+                    for field in ordering
+                ]
+            queryset = queryset.filter(
+                self._seek(values, reverse)).order_by(*ordering)
+        objects = list(queryset[:self.per_page + 1])
+        has_more = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        if reverse:
+            objects.reverse()
+        has_next = has_more if not reverse else True
+        has_previous = bool(cursor) if not reverse else has_more
+        if not objects:
+            has_next = has_previous = False
+        # Тип страницы должен остаться ровно Page, поэтому состояние
+        # курсора выражено через номер страницы и пагинатор: текущая
+        # страница вторая, если есть предыдущая, и последняя, если нет
+        # следующей. Тогда has_next(), next_page_number(), repr() и
+        # остальные методы Page работают без COUNT(*).
+        number = 2 if has_previous else 1
+        self.num_pages = number + 1 if has_next else number
+        self.count = (
+            self.per_page * (number - 1) + len(objects) + int(has_next))
+        page = Page(objects, number, self)
+        page.cursor_based = True
+        page.cursor = cursor
+        page.next_cursor = (
+            self.encode_cursor(objects[-1], 'next') if has_next else None)
+        page.previous_cursor = (
+            self.encode_cursor(objects[0], 'prev') if has_previous else None)
+        return page
+
 
+class CountedPaginator(Paginator):
+    """Paginator, который берет число объектов у count_provider.
 
-def page_paginator(post_list, request):
-    paginator = Paginator(post_list, POSTS_PER_PAGE)
+    Так COUNT(*) можно заменить кэшем или оценкой; при завышенной оценке
+    последние страницы просто оказываются пустыми.
+    """
+
+    def __init__(self, object_list, per_page, count_provider):
+        super().__init__(object_list, per_page)
+        self.count_provider = count_provider
+
+    @cached_property
+    def count(self):
+        return self.count_provider()
+
+
+def elided_page_range(number, num_pages,
+                      on_each_side=PAGE_RANGE_ON_EACH_SIDE,
+                      on_ends=PAGE_RANGE_ON_ENDS):
+    """Номера страниц для навигации, пропуски обозначены None.
+
+    Длина списка не зависит от числа страниц: края, окно вокруг текущей
+    и не больше двух пропусков.
+    """
+    if num_pages <= (on_each_side + on_ends) * 2:
+        return list(range(1, num_pages + 1))
+    numbers = []
+    if number > on_each_side + on_ends + 2:
+        numbers.extend(range(1, on_ends + 1))
+        numbers.append(None)
+        numbers.extend(range(number - on_each_side, number + 1))
+    else:
+        numbers.extend(range(1, number + 1))
+    if number < num_pages - on_each_side - on_ends - 1:
+        numbers.extend(range(number + 1, number + on_each_side + 1))
+        numbers.append(None)
+        numbers.extend(range(num_pages - on_ends + 1, num_pages + 1))
+    else:
+        numbers.extend(range(number + 1, num_pages + 1))
+    return numbers
+
+
+def numbered_page(paginator, number):
+    """Страница обычного Paginator с окном номеров elided_page_range."""
+    page = paginator.get_page(number)
+    page.elided_page_range = elided_page_range(
+        page.number, paginator.num_pages)
+    return page
+
+
+def page_paginator(post_list, request, ordering=FEED_ORDERING, count=None):
+    """Страница ленты для запроса.
+
+    По умолчанию лента листается курсором (?cursor=...); старые ссылки
+    вида ?page=N продолжают работать через обычный Paginator. count —
+    функция, возвращающая число постов вместо COUNT(*).
+    """
     page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    return page_obj
+    if page_number is not None:
+        post_list = post_list.order_by(*ordering)
+        if count is None:
+            paginator = Paginator(post_list, POSTS_PER_PAGE)
+        else:
+            paginator = CountedPaginator(post_list, POSTS_PER_PAGE, count)
+        return numbered_page(paginator, page_number)
+    paginator = CursorPaginator(post_list, POSTS_PER_PAGE, ordering)
+    return paginator.get_cursor_page(request.GET.get(CURSOR_PARAM, ''))
+
+
+def comments_page(post, cursor):
+    """Пачка комментариев поста (новые сверху) с авторами по курсору."""
+    paginator = CursorPaginator(
+        post.comments.with_authors(), COMMENTS_PER_PAGE, COMMENT_ORDERING)
+    return paginator.get_cursor_page(cursor)
@@ -0,0 +1,183 @@
+"""Картинки постов: учёт ссылок в контент-адресном хранилище и метаданные."""
+import base64
+import logging
+from io import BytesIO
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from PIL import Image, ImageOps
+from sorl.thumbnail import delete as delete_with_thumbnails
+from sorl.thumbnail.images import ImageFile
+
+from .models import Post, StoredImage, new_etag
+from .uploads import ORIENTATION_TAG
+
+
+logger = logging.getLogger(__name__)
+
+# Основной цвет считается по уменьшенной копии: JPEG при этом даже не
+# декодируется в полном размере (draft).
+COLOR_SAMPLE = 32
+# PNG и GIF draft() не уменьшает. При загрузке картинка декодируется
+# ради цвета и заглушки, только если в ней не больше стольких пикселей;
+# большие описывает фоновый обработчик превью.
+DEFAULT_SAMPLE_MAX_PIXELS = 4_000_000
+# Пропорция карточки поста: превью и заглушка обрезаются до неё.
+CARD_RATIO = 339 / 960
+# Крошечная копия картинки встраивается в страницу как data: URI и видна,
+# пока не загрузилось настоящее превью.
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 40
+# Как повернуть картинку по значению EXIF-ориентации.
+TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# Значения EXIF-ориентации, при которых картинка повернута на 90°.
+ROTATED = (5, 6, 7, 8)
+
+
+def sample_max_pixels():
+    return getattr(
+        settings, 'POST_IMAGE_SAMPLE_MAX_PIXELS', DEFAULT_SAMPLE_MAX_PIXELS)
+
+
+def source(name):
+    """Исходник для sorl-thumbnail: ключи превью зависят от хранилища."""
+    return ImageFile(name, Post.image.field.storage)
+
+
+def retain(name):
+    """Ещё один пост ссылается на картинку."""
+    if not name:
+        return
+    StoredImage.objects.get_or_create(name=name)
+    StoredImage.objects.filter(name=name).update(
+        references=F('references') + 1)
+
+
+def release(name):
+    """Пост больше не ссылается на картинку; последний удаляет файл.
+
+    Счётчик уменьшается под блокировкой строки, поэтому два поста,
+    удаляемые одновременно, не могут оба решить, что они последние.
+    """
+    if not name:
+        return
+    with transaction.atomic():
+        stored = (
+            StoredImage.objects.select_for_update()
+            .filter(name=name).first())
+        if stored is None:
+            return
+        if stored.references > 1 or Post.objects.filter(image=name).exists():
+            # Посты, обновлённые в обход сигналов, счётчик не учитывает:
+            # пока на файл есть ссылка, он остаётся.
+            StoredImage.objects.filter(pk=stored.pk).update(
+                references=Greatest(F('references') - 1, 0))
+            return
+        stored.delete()
+    # Пока блокировка была снята, тот же файл мог загрузить новый пост.
+    if StoredImage.objects.filter(name=name).exists():
+        return
+    try:
+        delete_with_thumbnails(source(name))
+    except (SuspiciousFileOperation, OSError):
+        logger.warning('Не удалось удалить картинку %s', name)
+
+
+def rename(old, new):
+    """Переводит посты и счётчик ссылок со старого имени файла на новое.
+
+    Превью старого имени удаляются (сам файл нет); возвращает число постов.
+    """
+    delete_with_thumbnails(source(old), delete_file=False)
+    with transaction.atomic():
+        moved = Post.objects.filter(image=old).update(
+            image=new, etag=new_etag())
+        stored = StoredImage.objects.filter(name=old).first()
+        references = stored.references if stored is not None else moved
+        StoredImage.objects.filter(name=old).delete()
+        StoredImage.objects.get_or_create(name=new)
+        StoredImage.objects.filter(name=new).update(
+            references=F('references') + references)
+    return moved
+
+
+def _placeholder(sample):
+    """Крошечная JPEG-копия карточки (с тем же кадрированием) в data: URI."""
+    sample = ImageOps.fit(
+        sample, (PLACEHOLDER_SIZE, round(PLACEHOLDER_SIZE * CARD_RATIO)))
+    buffer = BytesIO()
+    sample.save(buffer, 'JPEG', quality=PLACEHOLDER_QUALITY, optimize=True)
+    return 'data:image/jpeg;base64,' + base64.b64encode(
+        buffer.getvalue()).decode()
+
+
+def describe(file_, max_pixels=None):
+    """(ширина, высота, основной цвет, заглушка) картинки или None.
+
+    Цвет — строка '#rrggbb', заглушка — data: URI крошечной копии. Если
+    даже после draft() в картинке больше max_pixels пикселей, она не
+    декодируется, а цвет и заглушка остаются пустыми.
+    """
+    try:
+        file_.seek(0)
+        with Image.open(file_) as image:
+            width, height = image.size
+            orientation = image.getexif().get(ORIENTATION_TAG)
+            if orientation in ROTATED:
+                width, height = height, width
+            image.draft('RGB', (COLOR_SAMPLE, COLOR_SAMPLE))
+            if max_pixels is not None and (
+                    image.width * image.height > max_pixels):
+                return width, height, '', ''
+            image.thumbnail((COLOR_SAMPLE, COLOR_SAMPLE))
+            sample = image.convert('RGB')
+        if orientation in TRANSPOSE:
+            sample = sample.transpose(TRANSPOSE[orientation])
+        red, green, blue = sample.resize((1, 1), Image.BOX).getpixel((0, 0))
+        placeholder = _placeholder(sample)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    finally:
+        file_.seek(0)
+    return width, height, f'#{red:02x}{green:02x}{blue:02x}', placeholder
+
+
+def fill_metadata(post, file_=None):
+    """Записывает в пост размеры, цвет и заглушку картинки (без сохранения)."""
+    metadata = (
+        describe(file_, sample_max_pixels()) if file_ is not None else None)
+    (post.image_width, post.image_height, post.image_color,
+     post.image_placeholder) = metadata or (None, None, '', '')
+
+
+def complete_metadata(name):
+    """Дописывает цвет и заглушку, которые не посчитались при загрузке.
+
+    Вызывается фоновым обработчиком: здесь картинку можно декодировать
+    целиком. Возвращает число обновлённых постов.
+    """
+    posts = Post.objects.filter(image=name, image_placeholder='')
+    if not posts.exists():
+        return 0
+    try:
+        with Post.image.field.storage.open(name) as file_:
+            metadata = describe(file_)
+    except (OSError, SuspiciousFileOperation):
+        metadata = None
+    if metadata is None:
+        return 0
+    width, height, color, placeholder = metadata
+    return posts.update(
+        image_width=width, image_height=height, image_color=color,
+        image_placeholder=placeholder, etag=new_etag())
@@ -0,0 +1,218 @@
+"""KV-хранилище sorl-thumbnail без обращений к основной базе.
+
+Метаданные превью лежат в отдельном файле SQLite на локальном диске
+(по умолчанию рядом с самими превью, в MEDIA_ROOT/cache), который делят
+все процессы на хосте. Перед ним стоит ограниченный LRU в памяти процесса.
+
+В LRU попадают только найденные значения: превью готовит другой процесс
+(thumbnail_worker), и закэшированный промах прятал бы его работу. Записи
+LRU живут ограниченное время, чтобы удаления из других процессов тоже
+доходили до всех.
+
+Счётчики попаданий копятся в процессе и периодически складываются в тот же
+файл, так что manage.py thumbnail_kvstore_stats показывает сумму по хосту.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from sorl.thumbnail.images import deserialize_image_file
+from sorl.thumbnail.kvstores.base import KVStoreBase, add_prefix
+
+
+DEFAULT_LRU_SIZE = 4096
+DEFAULT_LRU_TIMEOUT = 60 * 5
+STATS_FLUSH_EVERY = 100
+# Ограничение SQLite на число параметров запроса в старых версиях — 999.
+MAX_BATCH = 500
+STATS = ('lru_hits', 'store_hits', 'misses')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS kvstore ('
+    'key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS stats ('
+    'name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID',
+)
+
+
+def store_path():
+    path = getattr(settings, 'THUMBNAIL_KVSTORE_PATH', None)
+    if path:
+        return path
+    return os.path.join(settings.MEDIA_ROOT, 'cache', 'thumbnails.sqlite3')
+
+
+class LRU:
+    """Потокобезопасный LRU с ограничением по числу записей и времени."""
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class KVStore(KVStoreBase):
+    """LRU в памяти процесса поверх общего файла SQLite."""
+
+    def __init__(self):
+        super().__init__()
+        self.lru = LRU(
+            getattr(settings, 'THUMBNAIL_KVSTORE_LRU_SIZE', DEFAULT_LRU_SIZE),
+            getattr(settings, 'THUMBNAIL_KVSTORE_LRU_TIMEOUT',
+                    DEFAULT_LRU_TIMEOUT),
+        )
+        self.counters = Counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # Соединение своё у каждого потока и процесса (после fork старое
+        # использовать нельзя); смена пути (например, MEDIA_ROOT в тестах)
+        # открывает новый файл и сбрасывает LRU.
+        path = store_path()
+        state = (os.getpid(), path)
+        if getattr(self._local, 'state', None) != state:
+            if getattr(self._local, 'path', path) != path:
+                self.lru.clear()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            connection = sqlite3.connect(
+                path, timeout=10, isolation_level=None,
+                check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._local.connection = connection
+            self._local.state = state
+            self._local.path = path
+        return self._local.connection
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+            pending = sum(self.counters.values())
+        if pending >= STATS_FLUSH_EVERY:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Складывает накопленные счётчики процесса в общий файл."""
+        with self._lock:
+            counters, self.counters = self.counters, Counter()
+        if counters:
+            self._connection().executemany(
+                'INSERT INTO stats (name, value) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET value = value + ?',
+                [(name, value, value) for name, value in counters.items()],
+            )
+
+    def stats(self):
+        """Счётчики по всем процессам хоста (включая ещё не сложенные)."""
+        self.flush_stats()
+        rows = dict(self._connection().execute(
+            'SELECT name, value FROM stats'))
+        return {name: rows.get(name, 0) for name in STATS}
+
+    def reset_stats(self):
+        with self._lock:
+            self.counters.clear()
+        self._connection().execute('DELETE FROM stats')
+
+    def clear(self):
+        self.lru.clear()
+        super().clear()
+
+    def _get_raw(self, key):
+        value = self.lru.get(key)
+        if value is not None:
+            self._count('lru_hits')
+            return value
+        row = self._connection().execute(
+            'SELECT value FROM kvstore WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        self._count('store_hits')
+        self.lru.set(key, row[0])
+        return row[0]
+
+    def get_many(self, image_files):
+        """Несколько записей за один запрос: {ключ: ImageFile}."""
+        keys = {add_prefix(image_file.key): image_file.key
+                for image_file in image_files}
+        return {
+            keys[key]: deserialize_image_file(value)
+            for key, value in self._get_many_raw(list(keys)).items()
+        }
+
+    def _get_many_raw(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.lru.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                self._count('lru_hits')
+                found[key] = value
+        for start in range(0, len(missing), MAX_BATCH):
+            batch = missing[start:start + MAX_BATCH]
+            rows = self._connection().execute(
+                'SELECT key, value FROM kvstore WHERE key IN (%s)'
+                % ', '.join('?' * len(batch)), batch)
+            for key, value in rows:
+                self._count('store_hits')
+                self.lru.set(key, value)
+                found[key] = value
+        for key in missing:
+            if key not in found:
+                self._count('misses')
+        return found
+
+    def _set_raw(self, key, value):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO kvstore (key, value) VALUES (?, ?)',
+            (key, value))
+        self.lru.set(key, value)
+
+    def _delete_raw(self, *keys):
+        self._connection().executemany(
+            'DELETE FROM kvstore WHERE key = ?', [(key,) for key in keys])
+        self.lru.delete(*keys)
+
+    def _find_keys_raw(self, prefix):
+        rows = self._connection().execute(
+            'SELECT key FROM kvstore WHERE substr(key, 1, ?) = ?',
+            (len(prefix), prefix))
+        return [key for key, in rows]
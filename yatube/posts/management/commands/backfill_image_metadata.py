@@ -0,0 +1,36 @@
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from posts.images import describe
+from posts.models import Post, new_etag
+
+
+class Command(BaseCommand):
+    help = 'Заполняет размеры, цвет и заглушки картинок у старых постов.'
+
+    def handle(self, *args, **options):
+        storage = Post.image.field.storage
+        names = (
+            Post.objects.exclude(image='')
+            .filter(Q(image_width__isnull=True) | Q(image_placeholder=''))
+            .order_by('image').values_list('image', flat=True).distinct()
+        )
+        filled = skipped = 0
+        # Один файл может быть у нескольких постов: читаем его один раз.
+        for name in names.iterator():
+            try:
+                with storage.open(name) as file_:
+                    metadata = describe(file_)
+            except (OSError, SuspiciousFileOperation):
+                metadata = None
+            if metadata is None:
+                self.stderr.write(f'Не удалось прочитать картинку {name}')
+                skipped += 1
+                continue
+            width, height, color, placeholder = metadata
+            filled += Post.objects.filter(image=name).update(
+                image_width=width, image_height=height, image_color=color,
+                image_placeholder=placeholder, etag=new_etag())
+        self.stdout.write(self.style.SUCCESS(
+            f'Заполнено постов: {filled}, пропущено картинок: {skipped}.'))
@@ -0,0 +1,98 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from posts.models import Post
+from posts.thumbnails import (
+    GEOMETRIES, dequeue, missing, refresh_pages, try_generate
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Готовит превью всех картинок постов параллельно на всех ядрах. '
+        'Картинки с готовыми превью пропускаются, поэтому прерванный '
+        'запуск можно просто повторить.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Число процессов (по умолчанию — по числу ядер); '
+                 '1 — без пула, в текущем процессе.')
+        parser.add_argument(
+            '--batch', type=int, default=200,
+            help='Сколько картинок брать из базы за раз.')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Пересоздать и уже готовые превью.')
+        parser.add_argument(
+            '--after', default='',
+            help='Начать с картинки, следующей за этой (из вывода '
+                 'прошлого запуска).')
+
+    def names(self, after, batch):
+        """Имена картинок пачками по возрастанию, начиная после after."""
+        images = (
+            Post.objects.exclude(image='').order_by('image')
+            .values_list('image', flat=True).distinct()
+        )
+        while True:
+            names = list(images.filter(image__gt=after)[:batch])
+            if not names:
+                return
+            after = names[-1]
+            yield names
+
+    def generate(self, pool, names, force):
+        """Успешно подготовленные картинки из списка."""
+        task = partial(try_generate, force=force)
+        if pool is None:
+            results = map(task, names)
+        else:
+            # Процессы пула создаются (fork) по мере надобности при map(),
+            # а names() и missing() уже снова открыли соединение с базой:
+            # дочерние процессы не должны его унаследовать.
+            connections.close_all()
+            results = pool.map(
+                task, names,
+                chunksize=max(1, len(names) // self.workers))
+        return [name for name, ok in zip(names, results) if ok]
+
+    def handle(self, *args, **options):
+        self.workers = options['workers']
+        total = (
+            Post.objects.exclude(image='').values('image').distinct().count())
+        seen = generated = failed = 0
+        started = time.monotonic()
+        with ExitStack() as stack:
+            pool = None
+            if self.workers > 1:
+                pool = stack.enter_context(ProcessPoolExecutor(
+                    self.workers, initializer=django.setup))
+            for names in self.names(options['after'], options['batch']):
+                seen += len(names)
+                todo = names if options['force'] else missing(names)
+                done = self.generate(pool, todo, options['force'])
+                generated += len(done)
+                failed += len(todo) - len(done)
+                dequeue(*done)
+                for name in done:
+                    refresh_pages(name)
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'{seen}/{total}: готово {generated}, ошибок {failed}, '
+                    f'{generated / elapsed:.1f} картинок/с; '
+                    f'последняя: {names[-1]}')
+        elapsed = time.monotonic() - started
+        thumbnails = generated * len(GEOMETRIES)
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово за {elapsed:.1f} с: картинок {generated} '
+            f'({generated / elapsed:.1f}/с), превью {thumbnails} '
+            f'({thumbnails / elapsed:.1f}/с), ошибок {failed}.'))
@@ -0,0 +1,101 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.core.paginator import Paginator
+from django.template import RequestContext
+from django.template.backends.django import DjangoTemplates
+from django.test import RequestFactory
+from django.utils import timezone
+
+from posts.cache import card_key
+from posts.helpers import POSTS_PER_PAGE, numbered_page
+from posts.models import Group, Post
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет время рендеринга страницы общей ленты (без запросов '
+        'к базе) с кэшем шаблонов и без него, с готовыми карточками постов '
+        'в кэше и без них.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repeat', type=int, default=200,
+            help='Сколько раз рендерить страницу.')
+        parser.add_argument(
+            '--posts', type=int, default=POSTS_PER_PAGE,
+            help='Сколько постов на странице.')
+
+    def engines(self):
+        params = {
+            key: value for key, value in settings.TEMPLATES[0].items()
+            if key != 'BACKEND'
+        }
+        engines = {}
+        for title, loaders in (
+                ('без кэша шаблонов', settings.BASE_TEMPLATE_LOADERS),
+                ('с кэшем шаблонов',
+                 [('django.template.loaders.cached.Loader',
+                   settings.BASE_TEMPLATE_LOADERS)])):
+            options = dict(params['OPTIONS'], loaders=loaders)
+            engines[title] = DjangoTemplates(dict(
+                params, NAME=title, APP_DIRS=False, OPTIONS=options)).engine
+        return engines
+
+    def context(self, count):
+        author = User(
+            pk=1, username='benchmark', first_name='Лев', last_name='Толстой')
+        group = Group(pk=1, title='Тестовая группа', slug='benchmark')
+        posts = [
+            Post(
+                pk=number, author=author, group=group,
+                text='Текст поста для замера. ' * 10,
+                pub_date=timezone.now(),
+            )
+            for number in range(1, count + 1)
+        ]
+        return {
+            # Нулевой таймаут: фрагментный кэш никогда не срабатывает.
+            'feed_cache_timeout': 0,
+            'feed_generation': 0,
+            'page_obj': numbered_page(Paginator(posts, count), 1),
+        }
+
+    def card_keys(self, posts):
+        """Ключи всех вариантов карточек постов страницы."""
+        return [
+            card_key(post, show_author, lazy)
+            for post in posts for show_author in (0, 1) for lazy in (0, 1)
+        ]
+
+    def handle(self, *args, **options):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        context = self.context(options['posts'])
+        card_keys = self.card_keys(context['page_obj'].object_list)
+        for title, engine in self.engines().items():
+            render = (
+                lambda: engine.get_template('posts/index.html').render(
+                    RequestContext(request, context)))
+            render()
+            for mode, stale in (
+                    ('карточки из кэша', []),
+                    ('без кэша карточек', card_keys)):
+                elapsed = 0
+                for _ in range(options['repeat']):
+                    # Сброс карточек в замер не входит.
+                    cache.delete_many(stale)
+                    started = time.perf_counter()
+                    render()
+                    elapsed += time.perf_counter() - started
+                elapsed /= options['repeat']
+                self.stdout.write(
+                    f'{title}, {mode}: {elapsed * 1000:.2f} мс на страницу')
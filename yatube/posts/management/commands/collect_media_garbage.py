@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from posts.garbage import DEFAULT_BATCH, DEFAULT_MIN_AGE, Collector
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет из MEDIA_ROOT картинки без постов и превью, о которых '
+        'не знает KV-хранилище.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch', type=int, default=DEFAULT_BATCH,
+            help='Сколько файлов проверять одним запросом.')
+        parser.add_argument(
+            '--min-age', type=int, default=DEFAULT_MIN_AGE,
+            help='Не трогать файлы моложе этого числа секунд.')
+        parser.add_argument(
+            '--quarantine', metavar='DIR',
+            help='Переносить мусор в этот каталог вместо удаления.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только посчитать, ничего не удаляя.')
+
+    def handle(self, *args, **options):
+        stats = Collector(
+            batch=options['batch'],
+            min_age=options['min_age'],
+            quarantine=options['quarantine'],
+            dry_run=options['dry_run'],
+        ).collect()
+        for kind, title in (('originals', 'Оригиналы'),
+                            ('thumbnails', 'Превью')):
+            self.stdout.write(
+                f'{title}: {stats[kind + "_files"]} файлов, '
+                f'{filesizeformat(stats[kind + "_bytes"])}')
+        total = stats['originals_bytes'] + stats['thumbnails_bytes']
+        verb = 'Можно освободить' if options['dry_run'] else 'Освобождено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb}: {filesizeformat(total)}.'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from posts.counters import recount_posts, recount_users
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает денормализованные счётчики постов и пользователей.'
+
+    def handle(self, *args, **options):
+        posts = recount_posts()
+        users = recount_users()
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитаны счётчики: постов — {posts}, '
+            f'пользователей — {users}.'
+        ))
@@ -0,0 +1,58 @@
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.management.base import BaseCommand
+
+from posts import images
+from posts.models import Post
+from posts.storage import SHARDED_PATTERN
+from posts.thumbnails import enqueue, refresh_pages
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит картинки постов из плоского каталога в подкаталоги '
+        'по хэшу. Команду можно прервать и запустить снова.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch', type=int, default=500,
+            help='Сколько файлов брать из базы за раз.')
+
+    def pending(self, after, batch):
+        upload_to = Post.image.field.upload_to
+        return list(
+            Post.objects.filter(image__startswith=upload_to, image__gt=after)
+            .exclude(image__regex=SHARDED_PATTERN)
+            .order_by('image').values_list('image', flat=True)
+            .distinct()[:batch]
+        )
+
+    def handle(self, *args, **options):
+        storage = Post.image.field.storage
+        moved = skipped = 0
+        # Прогресс хранится в самой базе: перенесённые имена уже не
+        # попадают в выборку. Курсор нужен, только чтобы не застрять
+        # на файлах, которые не удалось прочитать.
+        after = ''
+        while True:
+            names = self.pending(after, options['batch'])
+            if not names:
+                break
+            for name in names:
+                after = name
+                try:
+                    # Сначала копия, потом база, потом удаление старого
+                    # файла: на любом шаге перенос можно повторить.
+                    target = storage.shard(name)
+                except (OSError, SuspiciousFileOperation):
+                    self.stderr.write(f'Не удалось перенести {name}')
+                    skipped += 1
+                    continue
+                images.rename(name, target)
+                storage.delete(name)
+                refresh_pages(target)
+                enqueue(target)
+                moved += 1
+            self.stdout.write(f'Перенесено файлов: {moved}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово: перенесено {moved}, пропущено {skipped}.'))
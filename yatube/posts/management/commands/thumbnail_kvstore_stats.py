@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from sorl.thumbnail import default
+
+from posts.thumbnails import inline_stats, reset_inline_stats
+
+
+class Command(BaseCommand):
+    help = (
+        'Показывает счётчики KV-хранилища превью на этом хосте и '
+        'генерации превью при рендеринге.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Обнулить счётчики после вывода.')
+
+    def handle(self, *args, **options):
+        stats = default.kvstore.stats()
+        lookups = sum(stats.values())
+        hits = stats['lru_hits'] + stats['store_hits']
+        for name, value in stats.items():
+            self.stdout.write(f'{name}: {value}')
+        if lookups:
+            self.stdout.write(f'hit_rate: {hits / lookups:.1%}')
+        for name, value in inline_stats().items():
+            self.stdout.write(f'inline_{name}: {value}')
+        if options['reset']:
+            default.kvstore.reset_stats()
+            reset_inline_stats()
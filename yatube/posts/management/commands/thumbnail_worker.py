@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from posts.thumbnails import process_jobs
+
+
+class Command(BaseCommand):
+    help = 'Фоновый обработчик очереди превью картинок постов.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Обработать очередь один раз и выйти.')
+        parser.add_argument(
+            '--sleep', type=float, default=2,
+            help='Пауза между проверками пустой очереди, в секундах.')
+        parser.add_argument(
+            '--batch', type=int, default=50,
+            help='Сколько картинок брать из очереди за раз.')
+
+    def handle(self, *args, **options):
+        while True:
+            done, failed = process_jobs(limit=options['batch'])
+            if done or failed:
+                # Неудачные задания берутся снова, пока не кончатся
+                # попытки, поэтому цикл конечен.
+                self.stdout.write(
+                    f'Подготовлены превью: {done}, ошибок: {failed}')
+            elif options['once']:
+                return
+            else:
+                time.sleep(options['sleep'])
@@ -0,0 +1,40 @@
+# Generated by Django 2.2.16 on 2026-10-18 19:49
+
+from django.db import migrations
+
+
+TABLES = (
+    ('posts_post_fts', 'posts_post'),
+    ('posts_comment_fts', 'posts_comment'),
+)
+
+
+def create_fts_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for table, source in TABLES:
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {table} USING fts5("
+            f"text, tokenize='unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            f'INSERT INTO {table} (rowid, text) SELECT id, text FROM {source}'
+        )
+
+
+def drop_fts_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for table, source in TABLES:
+        schema_editor.execute(f'DROP TABLE {table}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0011_auto_20261018_1946'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_tables, drop_fts_tables),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-18 20:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0018_comment_post_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnailjob',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='Неудачных попыток'),
+        ),
+    ]
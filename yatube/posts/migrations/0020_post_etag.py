@@ -0,0 +1,19 @@
+# Generated by Django 2.2.16 on 2026-10-18 20:37
+
+from django.db import migrations, models
+import posts.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0019_thumbnailjob_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='etag',
+            field=models.CharField(default=posts.models.new_etag, editable=False, max_length=32, verbose_name='Версия'),
+        ),
+    ]
@@ -1,11 +1,44 @@
+from uuid import uuid4
+
 from django.db import models
 from django.contrib.auth import get_user_model
 
 from core.models import PubDateModel
+from .storage import ContentAddressedStorage
 
 
 User = get_user_model()
 POST_STR_LEN = 15
+FEED_FIELDS = (
+    'text',
+    'pub_date',
+    'etag',
+    'image',
+    'image_width',
+    'image_height',
+    'image_color',
+    'image_placeholder',
+    'author',
+    'author__username',
+    'author__first_name',
+    'author__last_name',
+    'group',
+    'group__slug',
+)
+COMMENT_FIELDS = (
+    'post',
+    'text',
+    'pub_date',
+    'author',
+    'author__username',
+    'author__first_name',
+    'author__last_name',
+)
+
+
+def new_etag():
+    """Новая версия поста для кэша карточек."""
+    return uuid4().hex
 
 
 class Group(models.Model):
@@ -17,6 +50,18 @@ class Group(models.Model):
         return self.title
 
 
+class PostQuerySet(models.QuerySet):
+    def for_feed(self):
+        """Посты с автором и группой одним запросом, только поля карточки."""
+        return self.select_related('author', 'group').only(*FEED_FIELDS)
+
+
+class CommentQuerySet(models.QuerySet):
+    def with_authors(self):
+        """Комментарии с авторами одним запросом, только поля карточки."""
+        return self.select_related('author').only(*COMMENT_FIELDS)
+
+
 class Post(PubDateModel):
     text = models.TextField(
         'Текст поста',
@@ -40,8 +85,61 @@ class Post(PubDateModel):
     image = models.ImageField(
         'Картинка',
         upload_to='posts/',
+        storage=ContentAddressedStorage(),
         blank=True
     )
+    # Размеры и основной цвет запоминаются при загрузке, чтобы шаблонам
+    # не нужно было открывать файл. width_field/height_field у ImageField
+    # не подходят: Django перечитывает файл при каждой загрузке модели,
+    # пока эти поля пусты.
+    image_width = models.PositiveIntegerField(
+        'Ширина картинки',
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    image_height = models.PositiveIntegerField(
+        'Высота картинки',
+        null=True,
+        blank=True,
+        editable=False,
+    )
+    image_color = models.CharField(
+        'Основной цвет картинки',
+        max_length=7,
+        blank=True,
+        editable=False,
+    )
+    image_placeholder = models.TextField(
+        'Заглушка картинки',
+        blank=True,
+        editable=False,
+    )
+    updated_at = models.DateTimeField(
+        'Дата изменения',
+        auto_now=True,
+    )
+    # Версия поста для кэша отрисованных карточек: меняется при каждом
+    # save(). Массовые update() мимо save() должны менять её сами, если
+    # меняют вид карточки.
+    etag = models.CharField(
+        'Версия',
+        max_length=32,
+        default=new_etag,
+        editable=False,
+    )
+    comments_count = models.PositiveIntegerField(
+        'Число комментариев',
+        default=0,
+        editable=False,
+    )
+
+    objects = PostQuerySet.as_manager()
+
+    class Meta(PubDateModel.Meta):
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'], name='post_feed_idx'),
+        ]
 
     def __str__(self):
         return self.text[:POST_STR_LEN]
@@ -65,6 +163,14 @@ class Comment(PubDateModel):
         help_text='Введите текст комментария'
     )
 
+    objects = CommentQuerySet.as_manager()
+
+    class Meta(PubDateModel.Meta):
+        indexes = [
+            models.Index(
+                fields=['post', '-pub_date', '-id'], name='comment_post_idx'),
+        ]
+
 
 class Follow(models.Model):
     user = models.ForeignKey(
@@ -85,3 +191,62 @@ class Follow(models.Model):
             models.UniqueConstraint(fields=['user', 'author'],
                                     name='unique_follow_pair')
         ]
+
+
+class TimelineEntry(models.Model):
+    """Пост в ленте подписок пользователя (fan-out при публикации)."""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='timeline',
+        verbose_name='Подписчик',
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='timeline_entries',
+        verbose_name='Пост',
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    class Meta:
+        ordering = ['-pub_date', '-post_id']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'post'],
+                                    name='unique_timeline_entry')
+        ]
+        indexes = [
+            models.Index(fields=['user', '-pub_date', '-post'],
+                         name='timeline_feed_idx'),
+        ]
+
+
+class UserStats(models.Model):
+    """Денормализованные счётчики пользователя."""
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats',
+        verbose_name='Пользователь',
+    )
+    posts_count = models.PositiveIntegerField('Число постов', default=0)
+    followers_count = models.PositiveIntegerField(
+        'Число подписчиков', default=0)
+    following_count = models.PositiveIntegerField('Число подписок', default=0)
+
+
+class ThumbnailJob(models.Model):
+    """Картинка, для которой фоновый обработчик должен подготовить превью."""
+    image = models.CharField('Картинка', max_length=255, unique=True)
+    created = models.DateTimeField('Дата постановки', auto_now_add=True)
+    # Неудачные попытки; после THUMBNAIL_MAX_ATTEMPTS задание остаётся в
+    # таблице, но больше не берётся, и картинка не ставится в очередь снова.
+    attempts = models.PositiveIntegerField('Неудачных попыток', default=0)
+
+
+class StoredImage(models.Model):
+    """Файл в контент-адресном хранилище и число постов, которые его
+    используют."""
+    name = models.CharField('Файл', max_length=255, unique=True)
+    references = models.PositiveIntegerField('Число ссылок', default=0)
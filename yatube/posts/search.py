@@ -0,0 +1,153 @@
+"""Полнотекстовый поиск по постам и комментариям.
+
+На SQLite тексты дублируются в виртуальные таблицы FTS5 (rowid совпадает
+с id поста или комментария) и ранжируются через bm25. На других СУБД
+поиск откатывается к icontains без ранжирования.
+"""
+import re
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from .models import Comment, Post
+
+
+POST_TABLE = 'posts_post_fts'
+COMMENT_TABLE = 'posts_comment_fts'
+# Совпадение в комментарии весит меньше, чем в тексте самого поста.
+COMMENT_WEIGHT = 0.5
+RANKED_SQL = f'''
+    SELECT post_id, MIN(score) AS score FROM (
+        SELECT rowid AS post_id, bm25({POST_TABLE}) AS score
+        FROM {POST_TABLE} WHERE {POST_TABLE} MATCH %s
+        UNION ALL
+        SELECT comment.post_id, bm25({COMMENT_TABLE}) * {COMMENT_WEIGHT}
+        FROM {COMMENT_TABLE}
+        JOIN posts_comment AS comment ON comment.id = {COMMENT_TABLE}.rowid
+        WHERE {COMMENT_TABLE} MATCH %s
+    ) GROUP BY post_id
+'''
+
+
+def is_supported():
+    return connection.vendor == 'sqlite'
+
+
+def build_match(query):
+    """Строка запроса FTS5: все слова обязательны, ищутся по префиксу."""
+    words = re.findall(r'\w+', query)
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def _index(table, pk, text):
+    if not is_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [pk])
+        cursor.execute(
+            f'INSERT INTO {table} (rowid, text) VALUES (%s, %s)', [pk, text])
+
+
+def _unindex(table, pk):
+    if not is_supported():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE rowid = %s', [pk])
+
+
+def index_post(post):
+    _index(POST_TABLE, post.pk, post.text)
+
+
+def unindex_post(post):
+    _unindex(POST_TABLE, post.pk)
+
+
+def index_comment(comment):
+    _index(COMMENT_TABLE, comment.pk, comment.text)
+
+
+def unindex_comment(comment):
+    _unindex(COMMENT_TABLE, comment.pk)
+
+
+def rebuild():
+    """Перестраивает индексы по текущему содержимому таблиц."""
+    if not is_supported():
+        return
+    with connection.cursor() as cursor:
+        for table, source in ((POST_TABLE, 'posts_post'),
+                              (COMMENT_TABLE, 'posts_comment')):
+            cursor.execute(f'DELETE FROM {table}')
+            cursor.execute(
+                f'INSERT INTO {table} (rowid, text) '
+                f'SELECT id, text FROM {source}'
+            )
+
+
+def _filter(queryset, table, query):
+    if not is_supported():
+        return queryset.filter(text__icontains=query)
+    match = build_match(query)
+    # Запрос без единого слова FTS5 считает синтаксической ошибкой.
+    if not match:
+        return queryset.none()
+    return queryset.filter(pk__in=RawSQL(
+        f'SELECT rowid FROM {table} WHERE {table} MATCH %s', [match]))
+
+
+def filter_posts(queryset, query):
+    """Посты, в тексте которых встречается запрос (для админки)."""
+    return _filter(queryset, POST_TABLE, query)
+
+
+def filter_comments(queryset, query):
+    """Комментарии, в тексте которых встречается запрос (для админки)."""
+    return _filter(queryset, COMMENT_TABLE, query)
+
+
+class SearchResults:
+    """Ленивая выдача для Paginator: считает и режет результаты в SQL."""
+
+    def __init__(self, query):
+        self.match = build_match(query)
+        self.query = query
+
+    def count(self):
+        if not self.match:
+            return 0
+        if not is_supported():
+            return self._fallback().count()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT COUNT(*) FROM ({RANKED_SQL})',
+                [self.match, self.match],
+            )
+            return cursor.fetchone()[0]
+
+    def _fallback(self):
+        return Post.objects.filter(
+            pk__in=Comment.objects.filter(
+                text__icontains=self.query).values('post')
+        ) | Post.objects.filter(text__icontains=self.query)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        if not self.match:
+            return []
+        if not is_supported():
+            return list(self._fallback().for_feed()[item])
+        start = item.start or 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'{RANKED_SQL} ORDER BY score, post_id DESC '
+                f'LIMIT %s OFFSET %s',
+                [self.match, self.match, item.stop - start, start],
+            )
+            post_ids = [row[0] for row in cursor.fetchall()]
+        posts = Post.objects.for_feed().in_bulk(post_ids)
+        return [posts[pk] for pk in post_ids if pk in posts]
@@ -0,0 +1,149 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import (
+    post_delete, post_save, pre_delete, pre_save
+)
+from django.dispatch import receiver
+
+from . import counters, images, search, timeline
+from .cache import (
+    GLOBAL_SCOPE, author_scope, bump_generations, group_scope, post_scope,
+    post_scopes, user_scope
+)
+from .models import Comment, Follow, Group, Post, new_etag
+
+
+User = get_user_model()
+# Поля пользователя, которые видны на карточках постов и комментариев.
+USER_NAME_FIELDS = ('username', 'first_name', 'last_name')
+
+
+@receiver(pre_save, sender=Post)
+def post_changing(sender, instance, **kwargs):
+    instance._previous_group_id = None
+    instance._previous_image = ''
+    instance.etag = new_etag()
+    if not instance.image:
+        images.fill_metadata(instance)
+    elif not instance.image._committed:
+        images.fill_metadata(instance, instance.image.file)
+    if instance.pk is not None:
+        instance._previous_group_id, instance._previous_image = (
+            Post.objects.filter(pk=instance.pk)
+            .values_list('group_id', 'image').first() or (None, ''))
+
+
+@receiver(post_save, sender=Post)
+def post_published(sender, instance, created, **kwargs):
+    bump_generations(
+        post_scope(instance.pk),
+        *post_scopes(
+            instance, getattr(instance, '_previous_group_id', None)),
+    )
+    search.index_post(instance)
+    previous_image = getattr(instance, '_previous_image', '')
+    if instance.image.name != previous_image:
+        images.retain(instance.image.name)
+        images.release(previous_image)
+    if created:
+        timeline.fan_out(instance)
+        counters.change_user_counter(instance.author_id, 'posts_count', 1)
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    bump_generations(post_scope(instance.pk), *post_scopes(instance))
+    search.unindex_post(instance)
+    images.release(instance.image.name)
+    counters.change_user_counter(instance.author_id, 'posts_count', -1)
+
+
+@receiver(post_save, sender=Comment)
+def comment_created(sender, instance, created, **kwargs):
+    bump_generations(post_scope(instance.post_id))
+    search.index_comment(instance)
+    if created:
+        counters.change_comments_counter(instance.post_id, 1)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    bump_generations(post_scope(instance.post_id))
+    search.unindex_comment(instance)
+    counters.change_comments_counter(instance.post_id, -1)
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    bump_generations(
+        user_scope(instance.user_id), user_scope(instance.author_id))
+    if created:
+        timeline.backfill(instance)
+        counters.change_user_counter(instance.user_id, 'following_count', 1)
+        counters.change_user_counter(instance.author_id, 'followers_count', 1)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    bump_generations(
+        user_scope(instance.user_id), user_scope(instance.author_id))
+    timeline.trim(instance)
+    counters.change_user_counter(instance.user_id, 'following_count', -1)
+    counters.change_user_counter(instance.author_id, 'followers_count', -1)
+
+
+def _group_feed_scopes(group_id):
+    """Ленты, в карточках которых есть ссылки на группу."""
+    author_ids = (
+        Post.objects.filter(group_id=group_id)
+        .values_list('author_id', flat=True).distinct())
+    return [
+        GLOBAL_SCOPE, group_scope(group_id),
+        *(author_scope(author_id) for author_id in author_ids),
+    ]
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleting(sender, instance, **kwargs):
+    # После удаления у постов уже не будет группы: авторов ищем заранее.
+    instance._feed_scopes = _group_feed_scopes(instance.pk)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_changed(sender, instance, created=False, **kwargs):
+    if created:
+        bump_generations(group_scope(instance.pk))
+        return
+    # Фрагменты общей ленты и профилей хранят готовые ссылки на группу.
+    scopes = getattr(instance, '_feed_scopes', None)
+    bump_generations(*(scopes or _group_feed_scopes(instance.pk)))
+
+
+@receiver(pre_save, sender=User)
+def user_changing(sender, instance, update_fields=None, **kwargs):
+    instance._name_changed = False
+    if instance.pk is None:
+        return
+    # Вход в систему сохраняет только last_login: лишний запрос не нужен.
+    if update_fields is not None and not set(update_fields) & set(
+            USER_NAME_FIELDS):
+        return
+    previous = User.objects.filter(pk=instance.pk).values_list(
+        *USER_NAME_FIELDS).first()
+    instance._name_changed = previous != tuple(
+        getattr(instance, field) for field in USER_NAME_FIELDS)
+
+
+@receiver(post_save, sender=User)
+def user_renamed(sender, instance, **kwargs):
+    if not getattr(instance, '_name_changed', False):
+        return
+    # Имя автора есть в кэше лент, где видны его посты; страницы постов
+    # с его комментариями зависят от user_scope (см. views.post_detail).
+    group_ids = (
+        Post.objects.filter(author_id=instance.pk, group__isnull=False)
+        .values_list('group_id', flat=True).distinct())
+    bump_generations(
+        GLOBAL_SCOPE, author_scope(instance.pk), user_scope(instance.pk),
+        *(group_scope(group_id) for group_id in group_ids),
+    )
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import posixpath
+import re
+import uuid
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+# Файлы раскладываются по подкаталогам из первых байтов хэша
+# (posts/ab/cd/abcd....jpg), чтобы в одном каталоге не копились сотни
+# тысяч файлов. Превью sorl-thumbnail раскладывает так же сам.
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+DIGEST = re.compile(r'[0-9a-f]{64}')
+# Имя уже в шардированной раскладке (для фильтра в базе).
+SHARDED_PATTERN = (
+    r'/' + r'[0-9a-f]{%d}/' % SHARD_WIDTH * SHARD_LEVELS
+    + r'[0-9a-f]{64}\.[^/]+$'
+)
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранилище, где имя файла — SHA-256 его содержимого.
+
+    Файлы лежат в подкаталогах по первым байтам хэша: posts/ab/cd/abcd...
+
+    Одинаковые картинки хранятся один раз: повторная загрузка возвращает
+    имя уже сохранённого файла. Превью sorl-thumbnail ключуются по имени
+    исходника, поэтому тоже общие. Сколько постов ссылается на файл,
+    считает StoredImage (см. posts.images).
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def sharded_name(self, directory, digest, extension):
+        shards = [
+            digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH]
+            for level in range(SHARD_LEVELS)
+        ]
+        return posixpath.join(directory, *shards, digest + extension.lower())
+
+    def content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        directory, filename = posixpath.split(name)
+        return self.sharded_name(
+            directory, digest.hexdigest(), posixpath.splitext(filename)[1])
+
+    def shard(self, name):
+        """Копирует файл из плоской раскладки в шардированную.
+
+        Возвращает новое имя; исходный файл остаётся на месте. Повторный
+        вызов ничего не копирует, поэтому перенос можно прерывать.
+        """
+        directory, filename = posixpath.split(name)
+        stem, extension = posixpath.splitext(filename)
+        if DIGEST.fullmatch(stem):
+            target = self.sharded_name(directory, stem, extension)
+            if self.exists(target):
+                return target
+        with self.open(name) as content:
+            return self._save(name, content)
+
+    def _save(self, name, content):
+        name = self.content_name(name, content)
+        if self.exists(name):
+            return name
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # Пишем во временный файл рядом и атомарно переименовываем:
+        # при гонке двух одинаковых загрузок оба пишут одно и то же.
+        temporary_path = f'{full_path}.{uuid.uuid4().hex}.part'
+        if hasattr(content, 'temporary_file_path'):
+            file_move_safe(content.temporary_file_path(), temporary_path)
+        else:
+            with open(temporary_path, 'wb') as destination:
+                for chunk in content.chunks():
+                    destination.write(chunk)
+        if self.file_permissions_mode is not None:
+            os.chmod(temporary_path, self.file_permissions_mode)
+        os.replace(temporary_path, full_path)
+        return name
@@ -0,0 +1,114 @@
+from django import template
+from django.core.cache import cache
+from django.template import Context
+from django.urls import reverse
+from django.utils.safestring import mark_safe
+
+from posts.cache import CARD_CACHE_TIMEOUT, card_key
+from posts.thumbnails import (
+    CARD_RATIO, CARD_SIZES, CARD_WIDTHS, card_variants, inline_variants,
+    prefetch_card_variants
+)
+
+
+register = template.Library()
+
+# Столько первых картинок ленты грузится сразу (они на первом экране),
+# остальные — лениво, по мере прокрутки.
+EAGER_IMAGES = 1
+
+
+def _picture(image, variants, request, lazy):
+    """Контекст шаблона includes/post_picture.html."""
+    if image and not variants:
+        variants = inline_variants(image, request)
+    variants = variants or {}
+    fallback = variants.get('image/jpeg') or next(iter(variants.values()), [])
+    post = image.instance if image else None
+    return {
+        'lazy': lazy,
+        'placeholder': getattr(post, 'image_placeholder', ''),
+        'image': image,
+        # Заглушка занимает место будущего превью: у него пропорции
+        # карточки, а не исходной картинки.
+        'width': CARD_WIDTHS[-1],
+        'height': round(CARD_WIDTHS[-1] * CARD_RATIO),
+        'color': getattr(post, 'image_color', ''),
+        'sources': [
+            {
+                'type': mime_type,
+                'srcset': ', '.join(
+                    f'{thumbnail.url} {width}w'
+                    for width, thumbnail in thumbnails),
+            }
+            for mime_type, thumbnails in variants.items()
+        ],
+        'fallback': fallback[-1][1] if fallback else None,
+        'sizes': CARD_SIZES,
+    }
+
+
+@register.inclusion_tag('includes/post_picture.html', takes_context=True)
+def post_picture(context, image):
+    """Картинка карточки с вариантами по ширине и формату."""
+    forloop = context.get('forloop')
+    return {'picture': _picture(
+        image,
+        card_variants(image) if image else None,
+        getattr(context, 'request', None),
+        forloop is not None and forloop['counter'] > EAGER_IMAGES,
+    )}
+
+
+def _card(post, picture):
+    """Контекст шаблона includes/post_card.html без самой картинки."""
+    author = post.author
+    return {
+        'post': post,
+        'author_name': author.get_full_name() or author.username,
+        'profile_url': reverse('posts:profile', args=[author.username]),
+        'detail_url': reverse('posts:post_detail', args=[post.pk]),
+        'group_url': (
+            reverse('posts:group_list', args=[post.group.slug])
+            if post.group_id else None),
+        'picture': picture,
+    }
+
+
+@register.simple_tag(takes_context=True)
+def post_cards(context, posts):
+    """Отрисованные карточки постов страницы.
+
+    Готовые карточки берутся из кэша одним запросом, по ключу с версией
+    поста; заново рисуются только недостающие, и только для них ищутся
+    варианты картинок.
+    """
+    # На странице автора подпись с автором у каждой карточки лишняя.
+    show_author = not context.get('author')
+    cards = []
+    # Сразу грузятся первые картинки страницы, а не картинки первых
+    # постов: посты без картинок места на экране почти не занимают.
+    images = 0
+    for post in posts:
+        images += bool(post.image)
+        lazy = bool(post.image) and images > EAGER_IMAGES
+        cards.append((post, card_key(post, int(show_author), int(lazy)), lazy))
+    cached = cache.get_many([key for _, key, _ in cards])
+    missing = [card for card in cards if card[1] not in cached]
+    if missing:
+        pictures = prefetch_card_variants(post.image for post, _, _ in missing)
+        request = getattr(context, 'request', None)
+        card_template = context.template.engine.get_template(
+            'includes/post_card.html')
+        rendered = {}
+        for post, key, lazy in missing:
+            picture = _picture(
+                post.image, pictures.get(post.image.name), request,
+                lazy) if post.image else None
+            rendered[key] = card_template.render(Context({
+                'card': _card(post, picture),
+                'show_author': show_author,
+            }, autoescape=context.autoescape))
+        cache.set_many(rendered, CARD_CACHE_TIMEOUT)
+        cached.update(rendered)
+    return [mark_safe(cached[key]) for _, key, _ in cards]
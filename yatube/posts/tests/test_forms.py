@@ -1,13 +1,21 @@
+import base64
+import os
 import tempfile
 import shutil
+from hashlib import sha256
+from io import BytesIO, StringIO
 
 from django.contrib.auth import get_user_model
 from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.management import call_command
+from PIL import Image
 
-from ..models import Post, Comment
+from ..models import Post, Comment, StoredImage
+from ..thumbnails import cached_thumbnails, card_variants
 
 
 User = get_user_model()
@@ -94,11 +102,12 @@ class PostCreateFormTests(TestCase):
             response,
             reverse('posts:profile', kwargs={'username': 'TestAuthor'})
         )
+        digest = sha256(small_gif).hexdigest()
         self.assertTrue(
             Post.objects.filter(
                 text='Тестовый текст',
                 group=None,
-                image='posts/small.gif',
+                image=f'posts/{digest[:2]}/{digest[2:4]}/{digest}.gif',
             ).exists()
         )
 
@@ -124,3 +133,229 @@ class PostCreateFormTests(TestCase):
                 group=None,
             ).exists()
         )
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class PostImageUploadTests(TestCase):
+    def setUp(self):
+        # Кэш помнит поставленные в очередь картинки прошлых тестов.
+        cache.clear()
+        self.author = User.objects.create(username='TestAuthor')
+        self.authorized_client = Client()
+        self.authorized_client.force_login(self.author)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def make_jpeg(self, size=(20, 10)):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        exif[0x8825] = {2: (55.0, 45.0, 0.0)}
+        buffer = BytesIO()
+        Image.new('RGB', size, 'red').save(
+            buffer, 'JPEG', exif=exif.tobytes(), comment=b'secret comment')
+        return SimpleUploadedFile(
+            'photo.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def upload(self, image):
+        return self.authorized_client.post(
+            reverse('posts:post_create'),
+            data={'text': 'Пост с фото', 'image': image},
+        )
+
+    def test_metadata_stripped(self):
+        """из загруженного JPEG вырезаются метаданные, кроме ориентации"""
+        self.upload(self.make_jpeg())
+        post = Post.objects.get(text='Пост с фото')
+        with post.image.open('rb') as stored:
+            content = stored.read()
+        self.assertNotIn(b'secret comment', content)
+        with Image.open(BytesIO(content)) as image:
+            exif = image.getexif()
+            self.assertEqual(image.size, (20, 10))
+        self.assertEqual(exif.get(0x0112), 6)
+        self.assertNotIn(0x8825, exif)
+
+    @override_settings(POST_IMAGE_MAX_BYTES=100)
+    def test_too_large_file_rejected(self):
+        """файл больше лимита по байтам отклоняется"""
+        response = self.upload(self.make_jpeg())
+        self.assertFalse(Post.objects.filter(text='Пост с фото').exists())
+        self.assertTrue(response.context['form'].has_error('image'))
+
+    @override_settings(POST_IMAGE_MAX_BYTES=1000)
+    def test_too_large_png_rejected_by_size(self):
+        """обрезанный при приёме PNG отклоняется по размеру, а не как битый"""
+        buffer = BytesIO()
+        Image.frombytes('RGB', (40, 40), os.urandom(40 * 40 * 3)).save(
+            buffer, 'PNG')
+        self.assertGreater(len(buffer.getvalue()), 1000)
+        response = self.upload(SimpleUploadedFile(
+            'photo.png', buffer.getvalue(), content_type='image/png'))
+        self.assertFalse(Post.objects.filter(text='Пост с фото').exists())
+        errors = response.context['form'].errors['image']
+        self.assertEqual(len(errors), 1)
+        self.assertIn('Файл слишком большой', errors[0])
+
+    @override_settings(POST_IMAGE_MAX_PIXELS=100)
+    def test_too_many_pixels_rejected(self):
+        """картинка больше лимита по пикселям отклоняется"""
+        response = self.upload(self.make_jpeg(size=(20, 10)))
+        self.assertFalse(Post.objects.filter(text='Пост с фото').exists())
+        self.assertTrue(response.context['form'].has_error('image'))
+
+    def test_same_image_stored_once(self):
+        """одинаковые картинки хранятся одним файлом со счётчиком ссылок"""
+        for text in ('Первый', 'Второй'):
+            self.authorized_client.post(
+                reverse('posts:post_create'),
+                data={'text': text, 'image': self.make_jpeg()},
+            )
+        first = Post.objects.get(text='Первый')
+        second = Post.objects.get(text='Второй')
+        self.assertEqual(first.image.name, second.image.name)
+        stored = StoredImage.objects.get(name=first.image.name)
+        self.assertEqual(stored.references, 2)
+        first.delete()
+        stored.refresh_from_db()
+        self.assertEqual(stored.references, 1)
+        self.assertTrue(second.image.storage.exists(second.image.name))
+        second.delete()
+        self.assertFalse(StoredImage.objects.exists())
+        self.assertFalse(second.image.storage.exists(second.image.name))
+
+    def test_last_release_deletes_thumbnails(self):
+        """с последней ссылкой удаляются и превью, и их записи в KV"""
+        self.upload(self.make_jpeg())
+        call_command('thumbnail_worker', '--once', stdout=StringIO())
+        post = Post.objects.get(text='Пост с фото')
+        thumbnails = [
+            thumbnail for variants in card_variants(post.image).values()
+            for _, thumbnail in variants
+        ]
+        self.assertTrue(thumbnails)
+        post.delete()
+        for thumbnail in thumbnails:
+            self.assertFalse(thumbnail.exists())
+        self.assertEqual(cached_thumbnails(thumbnails), {})
+
+    def test_release_keeps_referenced_file(self):
+        """файл, на который ещё ссылается пост, не удаляется"""
+        self.upload(self.make_jpeg())
+        kept = Post.objects.get(text='Пост с фото')
+        # Пост, созданный в обход сигналов, в счётчике не учтён.
+        Post.objects.bulk_create([Post(
+            author=self.author, text='Копия', image=kept.image.name)])
+        kept.delete()
+        storage = Post.image.field.storage
+        self.assertTrue(storage.exists(kept.image.name))
+        self.assertEqual(
+            StoredImage.objects.get(name=kept.image.name).references, 0)
+
+    def test_image_metadata_saved(self):
+        """размеры с учётом ориентации, цвет и заглушка запоминаются сразу"""
+        self.upload(self.make_jpeg())
+        post = Post.objects.get(text='Пост с фото')
+        self.assertEqual((post.image_width, post.image_height), (10, 20))
+        red, green, blue = (
+            int(post.image_color[i:i + 2], 16) for i in (1, 3, 5))
+        self.assertGreater(red, 200)
+        self.assertLess(max(green, blue), 50)
+        self.assertTrue(
+            post.image_placeholder.startswith('data:image/jpeg;base64,'))
+
+    def test_placeholder_has_card_proportions(self):
+        """заглушка обрезана так же, как превью карточки"""
+        self.upload(self.make_jpeg((40, 10)))
+        post = Post.objects.get(text='Пост с фото')
+        data = post.image_placeholder.split(',', 1)[1]
+        with Image.open(BytesIO(base64.b64decode(data))) as placeholder:
+            self.assertEqual(placeholder.size, (16, 6))
+
+    @override_settings(POST_IMAGE_SAMPLE_MAX_PIXELS=100)
+    def test_large_png_described_by_worker(self):
+        """большой PNG не декодируется при загрузке, цвет считает очередь"""
+        buffer = BytesIO()
+        Image.new('RGB', (20, 10), 'blue').save(buffer, 'PNG')
+        self.upload(SimpleUploadedFile(
+            'photo.png', buffer.getvalue(), content_type='image/png'))
+        post = Post.objects.get(text='Пост с фото')
+        self.assertEqual((post.image_width, post.image_height), (20, 10))
+        self.assertEqual(post.image_color, '')
+        self.assertEqual(post.image_placeholder, '')
+        call_command('thumbnail_worker', '--once', stdout=StringIO())
+        described = Post.objects.get(pk=post.pk)
+        self.assertEqual(described.image_color, '#0000ff')
+        self.assertTrue(described.image_placeholder.startswith(
+            'data:image/jpeg;base64,'))
+        self.assertNotEqual(described.etag, post.etag)
+
+    def test_backfill_image_metadata(self):
+        """команда заполняет метаданные у постов, где их нет"""
+        self.upload(self.make_jpeg())
+        Post.objects.update(
+            image_width=None, image_height=None, image_color='')
+        call_command('backfill_image_metadata', stdout=StringIO())
+        post = Post.objects.get(text='Пост с фото')
+        self.assertEqual((post.image_width, post.image_height), (10, 20))
+        self.assertTrue(post.image_color.startswith('#'))
+
+    def test_shard_post_images(self):
+        """команда переносит старые картинки в подкаталоги по хэшу"""
+        content = self.make_jpeg().read()
+        storage = Post.image.field.storage
+        os.makedirs(os.path.join(TEMP_MEDIA_ROOT, 'posts'), exist_ok=True)
+        with open(storage.path('posts/legacy.jpg'), 'wb') as legacy:
+            legacy.write(content)
+        post = Post.objects.create(author=self.author, text='Старый пост')
+        Post.objects.filter(pk=post.pk).update(image='posts/legacy.jpg')
+        StoredImage.objects.create(name='posts/legacy.jpg', references=1)
+        call_command('shard_post_images', stdout=StringIO())
+        call_command('shard_post_images', stdout=StringIO())
+        post.refresh_from_db()
+        digest = sha256(content).hexdigest()
+        self.assertEqual(
+            post.image.name, f'posts/{digest[:2]}/{digest[2:4]}/{digest}.jpg')
+        self.assertTrue(storage.exists(post.image.name))
+        self.assertFalse(storage.exists('posts/legacy.jpg'))
+        self.assertEqual(
+            StoredImage.objects.get(name=post.image.name).references, 1)
+        self.assertFalse(
+            StoredImage.objects.filter(name='posts/legacy.jpg').exists())
+
+    def test_collect_media_garbage(self):
+        """сборщик мусора убирает только файлы без ссылок"""
+        self.upload(self.make_jpeg())
+        self.authorized_client.post(
+            reverse('posts:post_create'),
+            data={'text': 'Брошенный', 'image': self.make_jpeg((30, 10))},
+        )
+        call_command('thumbnail_worker', '--once', stdout=StringIO())
+        kept = Post.objects.get(text='Пост с фото')
+        leaked = Post.objects.get(text='Брошенный').image.name
+        # Обновление в обход сигналов оставляет файл без ссылок.
+        Post.objects.filter(text='Брошенный').update(image='')
+        storage = Post.image.field.storage
+        stray = os.path.join(
+            TEMP_MEDIA_ROOT, 'cache', 'ab', 'cd', 'a' * 32 + '.jpg')
+        os.makedirs(os.path.dirname(stray), exist_ok=True)
+        with open(stray, 'wb') as thumbnail:
+            thumbnail.write(b'stray')
+
+        out = StringIO()
+        call_command(
+            'collect_media_garbage', '--min-age=0', '--dry-run', stdout=out)
+        self.assertIn('Оригиналы: 1 файлов', out.getvalue())
+        self.assertTrue(storage.exists(leaked))
+
+        call_command('collect_media_garbage', '--min-age=0', stdout=out)
+        self.assertFalse(storage.exists(leaked))
+        self.assertFalse(os.path.exists(stray))
+        self.assertFalse(StoredImage.objects.filter(name=leaked).exists())
+        self.assertTrue(storage.exists(kept.image.name))
+        variants = card_variants(kept.image)
+        self.assertEqual(len(variants['image/webp']), 3)
+        for thumbnail in variants['image/webp']:
+            self.assertTrue(thumbnail[1].exists())
@@ -1,7 +1,10 @@
+from io import StringIO
+
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.test import TestCase
 
-from ..models import Group, Post
+from ..models import Comment, Follow, Group, Post, UserStats
 
 
 User = get_user_model()
@@ -80,3 +83,43 @@ class GroupModelTest(TestCase):
         group = GroupModelTest.group
         group_str = str(group)
         self.assertEqual(group_str, 'Тестовая группа')
+
+
+class CountersTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(username='author')
+        self.reader = User.objects.create_user(username='reader')
+        self.post = Post.objects.create(author=self.author, text='Пост')
+
+    def stats(self, user):
+        return UserStats.objects.get(user=user)
+
+    def test_counters_follow_changes(self):
+        """Счётчики меняются при создании и удалении объектов."""
+        Post.objects.create(author=self.author, text='Второй пост')
+        comment = Comment.objects.create(
+            post=self.post, author=self.reader, text='Коммент')
+        follow = Follow.objects.create(user=self.reader, author=self.author)
+        self.post.refresh_from_db()
+        self.assertEqual(self.stats(self.author).posts_count, 2)
+        self.assertEqual(self.stats(self.author).followers_count, 1)
+        self.assertEqual(self.stats(self.reader).following_count, 1)
+        self.assertEqual(self.post.comments_count, 1)
+        comment.delete()
+        follow.delete()
+        self.post.delete()
+        self.assertEqual(self.stats(self.author).posts_count, 1)
+        self.assertEqual(self.stats(self.author).followers_count, 0)
+        self.assertEqual(self.stats(self.reader).following_count, 0)
+
+    def test_recount_counters_command(self):
+        """Команда recount_counters чинит разъехавшиеся счётчики."""
+        Comment.objects.create(
+            post=self.post, author=self.reader, text='Коммент')
+        UserStats.objects.update(posts_count=42)
+        Post.objects.update(comments_count=0)
+        call_command('recount_counters', stdout=StringIO())
+        self.post.refresh_from_db()
+        self.assertEqual(self.stats(self.author).posts_count, 1)
+        self.assertEqual(self.stats(self.reader).posts_count, 0)
+        self.assertEqual(self.post.comments_count, 1)
@@ -50,6 +50,9 @@ class PostsURLTests(TestCase):
                 )
         for response, template in responses.items():
             with self.subTest(response=response):
+                # Повторный анонимный запрос отдается из кэша страниц
+                # без рендеринга шаблона.
+                cache.clear()
                 self.assertTemplateUsed(
                     client.get(response),
                     template,
@@ -60,6 +63,7 @@ class PostsURLTests(TestCase):
         responses = {
             '/': 'posts/index.html',
             '/posts/1/': 'posts/post_detail.html',
+            '/posts/1/comments/': 'includes/comment_list.html',
             '/profile/HasNoName/': 'posts/profile.html',
             '/group/test/': 'posts/group_list.html',
         }
@@ -1,22 +1,58 @@
+import base64
+import json
+import os
 import tempfile
+import threading
+import time
 import shutil
+from io import BytesIO, StringIO
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, connections
 from django.urls import reverse
 from django import forms
+from django.core.paginator import Page
 from django.core.cache import cache
+from django.core.management import call_command
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
+from PIL import Image
+from sorl.thumbnail import default
 
-from ..models import Post, Group, Comment, Follow
+from ..models import (
+    Post, Group, Comment, Follow, ThumbnailJob, TimelineEntry
+)
 from ..forms import PostForm
+from ..thumbnails import (
+    GEOMETRIES, breaker, card_variants, enqueue, inline_stats, missing,
+    process_jobs, reset_inline_stats
+)
 
 
 User = get_user_model()
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
 
+def small_gif(name='small.gif', delay=b'\x0a'):
+    """Загруженная GIF-картинка 1×1.
+
+    Картинки хранятся по хэшу содержимого, поэтому разным постам нужны
+    разные файлы: их отличает задержка кадра (delay).
+    """
+    return SimpleUploadedFile(
+        name,
+        b'\x47\x49\x46\x38\x39\x61\x01\x00'
+        b'\x01\x00\x00\x00\x00\x21\xf9\x04'
+        b'\x01' + delay + b'\x00\x01\x00\x2c\x00\x00'
+        b'\x00\x00\x01\x00\x01\x00\x00\x02'
+        b'\x02\x4c\x01\x00\x3b',
+        content_type='image/gif',
+    )
+
+
 class PostsPagesTests(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -124,6 +160,123 @@ class PostsPagesTests(TestCase):
                     paginator_len
                 )
 
+    def test_cursor_pagination(self):
+        """курсорная пагинация проходит ленту без пропусков и повторов"""
+        Post.objects.bulk_create(
+            Post(author=PostsPagesTests.author, text=f'Пост {i}')
+            for i in range(24)
+        )
+        url = reverse('posts:index')
+        seen = []
+        response = self.authorized_client.get(url)
+        first_page = list(response.context['page_obj'].object_list)
+        self.assertIsNone(response.context['page_obj'].previous_cursor)
+        while True:
+            page_obj = response.context['page_obj']
+            seen.extend(page_obj.object_list)
+            if page_obj.next_cursor is None:
+                break
+            last_page = page_obj
+            response = self.authorized_client.get(
+                url, {'cursor': page_obj.next_cursor})
+        self.assertEqual(seen, list(Post.objects.order_by('-pub_date', '-pk')))
+        self.assertEqual(len(page_obj.object_list), 5)
+        response = self.authorized_client.get(
+            url, {'cursor': page_obj.previous_cursor})
+        self.assertEqual(
+            list(response.context['page_obj'].object_list),
+            list(last_page.object_list)
+        )
+        response = self.authorized_client.get(url, {'cursor': 'мусор'})
+        self.assertEqual(
+            list(response.context['page_obj'].object_list),
+            first_page
+        )
+        post_id = PostsPagesTests.post.pk
+        pages = {
+            url: 'cursor',
+            reverse('posts:profile', args=['TestAuthor']): 'cursor',
+            reverse('posts:post_detail', args=[post_id]): 'comments',
+            reverse('posts:post_comments', args=[post_id]): 'cursor',
+        }
+        # Самодельные курсоры: ключ не разбирается или пуст.
+        for payload in (
+            ['next', 'garbage', '1'],
+            ['next', '2020-01-01T00:00:00+00:00', 'abc'],
+            ['next', None, None],
+        ):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(payload).encode()).decode()
+            for page_url, param in pages.items():
+                with self.subTest(payload=payload, page_url=page_url):
+                    response = self.authorized_client.get(
+                        page_url, {param: cursor})
+                    self.assertEqual(response.status_code, 200)
+        response = self.authorized_client.get(
+            url, {'cursor': cursor})
+        self.assertEqual(
+            list(response.context['page_obj'].object_list),
+            first_page
+        )
+
+    def test_cursor_page_methods(self):
+        """методы Page у курсорной страницы работают без COUNT(*)"""
+        Post.objects.bulk_create(
+            Post(author=PostsPagesTests.author, text=f'Пост {i}')
+            for i in range(14)
+        )
+        url = reverse('posts:index')
+        with CaptureQueriesContext(connection) as queries:
+            first = self.authorized_client.get(url).context['page_obj']
+            self.assertTrue(first.has_next())
+            self.assertFalse(first.has_previous())
+            self.assertTrue(first.has_other_pages())
+            self.assertEqual(first.next_page_number(), 2)
+            self.assertEqual(first.start_index(), 1)
+            self.assertEqual(first.end_index(), 10)
+            self.assertEqual(repr(first), '<Page 1 of 2>')
+            last = self.authorized_client.get(
+                url, {'cursor': first.next_cursor}).context['page_obj']
+            self.assertFalse(last.has_next())
+            self.assertTrue(last.has_previous())
+            self.assertEqual(last.previous_page_number(), 1)
+            self.assertEqual(last.end_index(), 15)
+            self.assertEqual(repr(last), '<Page 2 of 2>')
+        self.assertFalse(any(
+            'COUNT(' in query['sql'] for query in queries.captured_queries))
+
+    def test_feed_query_count(self):
+        """число запросов ленты не зависит от количества постов"""
+        self.new_relation_creation()
+        pages = [
+            reverse('posts:index'),
+            reverse('posts:follow_index'),
+            reverse('posts:group_list',
+                    kwargs={'group_condition': 'test-group'}),
+            reverse('posts:profile', kwargs={'username': 'TestAuthor'}),
+        ]
+
+        def queries_per_page():
+            counts = []
+            for page in pages:
+                cache.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    self.new_authorized_client.get(page)
+                counts.append(len(queries))
+            return counts
+
+        self.new_post_creation()
+        few = queries_per_page()
+        for i in range(9):
+            author = User.objects.create(username=f'FeedAuthor{i}')
+            Follow.objects.create(user=PostsPagesTests.new_user, author=author)
+            Post.objects.create(
+                author=author,
+                text=f'Пост {i}',
+                group=PostsPagesTests.group,
+            )
+        self.assertEqual(queries_per_page(), few)
+
     def test_post_detail(self):
         """правильный контекст для показа детального поста"""
         response = (self.authorized_client.get(
@@ -214,12 +367,88 @@ class PostsPagesTests(TestCase):
                     kwargs={'post_id': new_post_with_group.pk}))
         self.assertTrue(comment not in response.context.get('comments'))
 
+    def test_comments_paginated(self):
+        """комментарии поста листаются курсором и подгружаются фрагментом"""
+        post = self.new_post_creation()
+        authors = [
+            User.objects.create(username=f'Commenter{i}') for i in range(3)]
+        Comment.objects.bulk_create(
+            Comment(post=post, author=authors[i % 3], text=f'Коммент {i}')
+            for i in range(45)
+        )
+        expected = list(post.comments.order_by('-pub_date', '-pk'))
+        detail_url = reverse('posts:post_detail', kwargs={'post_id': post.pk})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.authorized_client.get(detail_url)
+        first_page = response.context['comments']
+        self.assertEqual(list(first_page), expected[:20])
+        self.assertIsNotNone(first_page.next_cursor)
+        comment_queries = [
+            query for query in queries.captured_queries
+            if 'posts_comment' in query['sql']
+        ]
+        self.assertEqual(len(comment_queries), 1)
+        fragment_url = reverse(
+            'posts:post_comments', kwargs={'post_id': post.pk})
+        response = self.client.get(
+            fragment_url, {'cursor': first_page.next_cursor})
+        self.assertTemplateUsed(response, 'includes/comment_list.html')
+        self.assertTemplateNotUsed(response, 'base.html')
+        second_page = response.context['comments']
+        self.assertEqual(list(second_page), expected[20:40])
+        response = self.client.get(
+            fragment_url, {'cursor': second_page.next_cursor})
+        self.assertEqual(list(response.context['comments']), expected[40:])
+        self.assertIsNone(response.context['comments'].next_cursor)
+        self.assertNotContains(response, 'Показать ещё комментарии')
+        response = self.client.get(
+            detail_url, {'comments': first_page.next_cursor})
+        self.assertEqual(list(response.context['comments']), expected[20:40])
+
+    def test_post_cards(self):
+        """карточки ленты со ссылками; на странице автора без подписи"""
+        cache.clear()
+        new_post = self.new_post_creation()
+        profile_url = reverse(
+            'posts:profile', kwargs={'username': 'TestAuthor'})
+        response = self.authorized_client.get(reverse('posts:index'))
+        self.assertContains(response, 'все посты пользователя')
+        self.assertContains(response, f'href="{profile_url}"')
+        self.assertContains(response, 'href="{}"'.format(reverse(
+            'posts:post_detail', kwargs={'post_id': new_post.pk})))
+        self.assertContains(response, 'href="{}"'.format(reverse(
+            'posts:group_list', kwargs={'group_condition': 'test-group'})))
+        response = self.authorized_client.get(profile_url)
+        self.assertContains(response, new_post.text)
+        self.assertNotContains(response, 'все посты пользователя')
+
+    def test_post_card_cache(self):
+        """карточка берется из кэша, пока не изменилась версия поста"""
+        cache.clear()
+        post = self.new_post_creation()
+        follow_url = reverse('posts:follow_index')
+        Follow.objects.create(
+            user=PostsPagesTests.new_user, author=PostsPagesTests.author)
+        response = self.new_authorized_client.get(follow_url)
+        self.assertContains(response, post.text)
+        Post.objects.filter(pk=post.pk).update(text='Тихая правка')
+        response = self.new_authorized_client.get(follow_url)
+        self.assertNotContains(response, 'Тихая правка')
+        self.authorized_client.post(
+            reverse('posts:post_edit', kwargs={'post_id': post.pk}),
+            data={'text': 'Новый текст', 'group': post.group.pk},
+        )
+        response = self.new_authorized_client.get(follow_url)
+        self.assertContains(response, 'Новый текст')
+        self.assertNotContains(response, post.text)
+
     def test_z_index_page_cache(self):
-        """открытие главной страницы из кэша"""
+        """главная страница берется из кэша, пока посты не менялись"""
         cache.clear()
         PostsPagesTests.authorized_client.get(
             reverse('posts:index'))
-        PostsPagesTests.post.delete()
+        Post.objects.filter(pk=PostsPagesTests.post.pk).update(
+            text='Текст в обход сигналов')
         response = PostsPagesTests.authorized_client.get(
             reverse('posts:index'))
         self.assertContains(response, 'Текст поста 111')
@@ -228,6 +457,163 @@ class PostsPagesTests(TestCase):
             reverse('posts:index'))
         self.assertNotContains(response, 'Текст поста 111')
 
+    def test_feed_cache_invalidation(self):
+        """изменение поста сразу сбрасывает кэш всех его лент"""
+        cache.clear()
+        post = self.new_post_creation()
+        pages = [
+            reverse('posts:index'),
+            reverse('posts:group_list',
+                    kwargs={'group_condition': 'test-group'}),
+            reverse('posts:profile', kwargs={'username': 'TestAuthor'}),
+        ]
+        for page in pages:
+            self.assertContains(
+                self.authorized_client.get(page),
+                'Текст поста для подписчиков'
+            )
+        post.text = 'Отредактированный текст'
+        post.save()
+        for page in pages:
+            with self.subTest(page=page):
+                self.assertContains(
+                    self.authorized_client.get(page),
+                    'Отредактированный текст'
+                )
+        post.delete()
+        for page in pages:
+            with self.subTest(page=page):
+                self.assertNotContains(
+                    self.authorized_client.get(page),
+                    'Отредактированный текст'
+                )
+
+    def test_anonymous_page_cache(self):
+        """страницы для анонимов кэшируются и сбрасываются при изменениях"""
+        cache.clear()
+        guest_client = Client()
+        post = PostsPagesTests.post
+        url = reverse('posts:post_detail', kwargs={'post_id': post.pk})
+        response = guest_client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'MISS')
+        response = guest_client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'HIT')
+        Comment.objects.create(
+            text='Свежий коммент',
+            author=PostsPagesTests.new_user,
+            post=post,
+        )
+        response = guest_client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'MISS')
+        self.assertContains(response, 'Свежий коммент')
+        response = guest_client.get(url, {'utm': 1})
+        self.assertEqual(response['X-Page-Cache'], 'MISS')
+        response = PostsPagesTests.authorized_client.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'BYPASS')
+
+    def test_page_cache_user_renamed(self):
+        """смена имени пользователя сбрасывает страницы с его именем"""
+        cache.clear()
+        guest_client = Client()
+        author = User.objects.create(username='Renamed')
+        post = Post.objects.create(
+            author=author, text='Пост переименованного',
+            group=PostsPagesTests.group)
+        Comment.objects.create(
+            text='Коммент переименованного', author=author,
+            post=PostsPagesTests.post)
+        urls = [
+            reverse('posts:index'),
+            reverse('posts:group_list',
+                    kwargs={'group_condition': 'test-group'}),
+            reverse('posts:post_detail', kwargs={'post_id': post.pk}),
+            reverse('posts:post_detail',
+                    kwargs={'post_id': PostsPagesTests.post.pk}),
+        ]
+        for url in urls:
+            guest_client.get(url)
+        author.first_name = 'Новое'
+        author.last_name = 'Имя'
+        author.save()
+        for url in urls:
+            with self.subTest(url=url):
+                response = guest_client.get(url)
+                self.assertEqual(response['X-Page-Cache'], 'MISS')
+                self.assertContains(response, 'Новое Имя')
+        author.save(update_fields=['last_login'])
+        response = guest_client.get(urls[0])
+        self.assertEqual(response['X-Page-Cache'], 'HIT')
+
+    def test_group_renamed(self):
+        """смена адреса группы обновляет ссылки в лентах и профилях"""
+        cache.clear()
+        group = Group.objects.create(title='Старая', slug='old-slug')
+        Post.objects.create(
+            author=PostsPagesTests.author, text='Пост в группе', group=group)
+        urls = [
+            reverse('posts:index'),
+            reverse('posts:profile', kwargs={'username': 'TestAuthor'}),
+        ]
+        clients = (Client(), self.authorized_client)
+        for client in clients:
+            for url in urls:
+                self.assertContains(client.get(url), '/group/old-slug/')
+        group.slug = 'new-slug'
+        group.save()
+        for client in clients:
+            for url in urls:
+                with self.subTest(url=url):
+                    response = client.get(url)
+                    self.assertNotContains(response, '/group/old-slug/')
+                    self.assertContains(response, '/group/new-slug/')
+
+    def test_search(self):
+        """поиск находит посты по тексту и комментариям"""
+        by_text = Post.objects.create(
+            author=PostsPagesTests.author,
+            text='Рыжий кот спит на подоконнике',
+        )
+        by_comment = Post.objects.create(
+            author=PostsPagesTests.author,
+            text='Фото без подписи',
+        )
+        Comment.objects.create(
+            post=by_comment,
+            author=PostsPagesTests.new_user,
+            text='Какой рыжий!',
+        )
+        deleted = Post.objects.create(
+            author=PostsPagesTests.author,
+            text='Рыжий пост, который удалят',
+        )
+        deleted.delete()
+        response = self.authorized_client.get(
+            reverse('posts:search'), {'q': 'рыжи'})
+        self.assertEqual(
+            list(response.context['page_obj'].object_list),
+            [by_text, by_comment]
+        )
+        response = self.authorized_client.get(
+            reverse('posts:search'), {'q': 'рыжий подоконник'})
+        self.assertEqual(
+            list(response.context['page_obj'].object_list), [by_text])
+        response = self.authorized_client.get(
+            reverse('posts:search'), {'q': '"*)'})
+        self.assertEqual(len(response.context['page_obj'].object_list), 0)
+        admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        admin_client = Client()
+        admin_client.force_login(admin)
+        for model in ('post', 'comment'):
+            with self.subTest(model=model):
+                response = admin_client.get(
+                    reverse(f'admin:posts_{model}_changelist'),
+                    {'q': 'рыжий'})
+                self.assertEqual(response.context['cl'].result_count, 1)
+                response = admin_client.get(
+                    reverse(f'admin:posts_{model}_changelist'), {'q': '!!'})
+                self.assertEqual(response.context['cl'].result_count, 0)
+
     def test_follow(self):
         """можно подписаться на автора"""
         PostsPagesTests.new_authorized_client.post(
@@ -263,6 +649,24 @@ class PostsPagesTests(TestCase):
             reverse('posts:follow_index'))
         self.assertNotContains(response, 'Текст поста для подписчиков')
 
+    def test_timeline_fan_out(self):
+        """лента подписок материализуется при подписке и публикации"""
+        timeline = PostsPagesTests.new_user.timeline
+        follow = self.new_relation_creation()
+        self.assertEqual(
+            list(timeline.values_list('post', flat=True)),
+            [PostsPagesTests.post.pk]
+        )
+        new_post = self.new_post_creation()
+        self.assertEqual(
+            list(timeline.values_list('post', flat=True)),
+            [new_post.pk, PostsPagesTests.post.pk]
+        )
+        follow.delete()
+        self.assertFalse(timeline.exists())
+        self.assertFalse(
+            TimelineEntry.objects.filter(user=PostsPagesTests.author).exists())
+
     def test_comment_only_for_auth(self):
         """комментарий может написат только авторизованный пользователь"""
         guest_client = Client()
@@ -276,21 +680,9 @@ class PostsPagesTests(TestCase):
 
     def test_post_image_on_pages(self):
         """пост с картинкой отображается на всех нужных страницах"""
-        small_gif = (
-            b'\x47\x49\x46\x38\x39\x61\x01\x00'
-            b'\x01\x00\x00\x00\x00\x21\xf9\x04'
-            b'\x01\x0a\x00\x01\x00\x2c\x00\x00'
-            b'\x00\x00\x01\x00\x01\x00\x00\x02'
-            b'\x02\x4c\x01\x00\x3b'
-        )
-        uploaded = SimpleUploadedFile(
-            name='small.gif',
-            content=small_gif,
-            content_type='image/gif',
-        )
         new_post_with_image = Post.objects.create(
             text='Тестовый текст',
-            image=uploaded,
+            image=small_gif(),
             author=PostsPagesTests.author,
             group=PostsPagesTests.group,
         )
@@ -310,3 +702,315 @@ class PostsPagesTests(TestCase):
                 response = PostsPagesTests.new_authorized_client.get(
                     page_name)
                 self.assertContains(response, '<img')
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_INLINE_BUDGET=0)
+    def test_thumbnail_worker(self):
+        """превью готовит фоновый обработчик, до этого видна LQIP-заглушка"""
+        response = self.authorized_client.post(
+            reverse('posts:post_create'),
+            data={
+                'text': 'Пост с картинкой',
+                'image': small_gif('worker.gif'),
+            },
+        )
+        post = Post.objects.get(text='Пост с картинкой')
+        self.assertTrue(
+            ThumbnailJob.objects.filter(image=post.image.name).exists())
+        response = self.authorized_client.get(reverse('posts:index'))
+        self.assertContains(response, 'Картинка готовится')
+        self.assertContains(response, 'src="data:image/jpeg;base64,')
+        # Место под превью — в пропорциях карточки, а не картинки 1×1.
+        self.assertContains(response, 'width="960" height="339"')
+        call_command('thumbnail_worker', '--once', stdout=StringIO())
+        self.assertFalse(ThumbnailJob.objects.exists())
+        # Готовые превью меняют версию карточки, но не дату изменения.
+        refreshed = Post.objects.get(pk=post.pk)
+        self.assertNotEqual(refreshed.etag, post.etag)
+        self.assertEqual(refreshed.updated_at, post.updated_at)
+        response = self.authorized_client.get(reverse('posts:index'))
+        self.assertNotContains(response, 'Картинка готовится')
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, '.webp 320w')
+        self.assertContains(response, '.jpg 960w')
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_INLINE_BUDGET=0)
+    def test_thumbnail_worker_failures(self):
+        """битая картинка не считается готовой и не встает в очередь снова"""
+        cache.clear()
+        post = Post.objects.create(
+            author=self.author,
+            text='Пост с битой картинкой',
+            image=SimpleUploadedFile(
+                'broken.png', b'not an image', 'image/png'),
+        )
+        enqueue(post.image.name)
+        out = StringIO()
+        call_command('thumbnail_worker', '--once', stdout=out)
+        self.assertIn('Подготовлены превью: 0, ошибок: 1', out.getvalue())
+        job = ThumbnailJob.objects.get(image=post.image.name)
+        self.assertEqual(job.attempts, settings.THUMBNAIL_MAX_ATTEMPTS)
+        self.assertEqual(process_jobs(), (0, 0))
+        for _ in range(2):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.authorized_client.get(reverse('posts:index'))
+            self.assertContains(response, 'Картинка готовится')
+            self.assertFalse(any(
+                'posts_thumbnailjob' in query['sql']
+                for query in queries.captured_queries
+            ))
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+    def test_thumbnail_kvstore_avoids_database(self):
+        """метаданные превью читаются без запросов к основной базе"""
+        post = Post.objects.create(
+            author=self.author,
+            text='Пост для KV-хранилища',
+            image=small_gif('kvstore.gif', b'\x0b'),
+        )
+        enqueue(post.image.name)
+        call_command('thumbnail_worker', '--once', stdout=StringIO())
+        call_command('thumbnail_kvstore_stats', '--reset', stdout=StringIO())
+        for _ in range(2):
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.authorized_client.get(reverse('posts:index'))
+            self.assertContains(response, '.webp 320w')
+            self.assertFalse(any(
+                'thumbnail_kvstore' in query['sql']
+                for query in queries.captured_queries
+            ))
+        out = StringIO()
+        call_command('thumbnail_kvstore_stats', stdout=out)
+        self.assertIn('store_hits: 0', out.getvalue())
+        self.assertIn('misses: 0', out.getvalue())
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+    def test_thumbnails_prefetched_for_page(self):
+        """превью всех постов страницы ищутся одним запросом"""
+        for delay in (b'\x0c', b'\x0d'):
+            post = Post.objects.create(
+                author=self.author,
+                text='Пост с превью',
+                image=small_gif('prefetch.gif', delay),
+            )
+            enqueue(post.image.name)
+        call_command('thumbnail_worker', '--once', stdout=StringIO())
+        cache.clear()
+        kvstore = default.kvstore
+        with mock.patch.object(
+                kvstore, 'get', side_effect=AssertionError), \
+                mock.patch.object(
+                    kvstore, 'get_many', wraps=kvstore.get_many) as get_many:
+            response = self.authorized_client.get(reverse('posts:index'))
+        self.assertEqual(get_many.call_count, 1)
+        content = response.content.decode()
+        self.assertEqual(content.count('.webp 320w'), 2)
+        # Первая картинка на первом экране, вторая грузится лениво.
+        self.assertEqual(content.count('loading="lazy"'), 1)
+        self.assertEqual(content.count('url(data:image/jpeg;base64,'), 2)
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+    def test_first_image_eager_after_text_posts(self):
+        """первая картинка грузится сразу и после постов без картинок"""
+        Post.objects.create(
+            author=self.author, text='Пост с картинкой',
+            image=small_gif('eager.gif', b'\x12'))
+        Post.objects.create(author=self.author, text='Пост без картинки')
+        cache.clear()
+        response = self.authorized_client.get(reverse('posts:index'))
+        self.assertContains(response, '<img')
+        self.assertNotContains(response, 'loading="lazy"')
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+    def test_backfill_thumbnails(self):
+        """команда готовит недостающие превью и пропускает готовые"""
+        post = Post.objects.create(
+            author=self.author,
+            text='Пост для пересоздания превью',
+            image=small_gif('backfill.gif', b'\x0e'),
+        )
+        enqueue(post.image.name)
+        out = StringIO()
+        call_command('backfill_thumbnails', '--workers=1', stdout=out)
+        self.assertIn('картинок 1 ', out.getvalue())
+        self.assertFalse(ThumbnailJob.objects.exists())
+        response = self.authorized_client.get(reverse('posts:index'))
+        self.assertContains(response, '.webp 320w')
+        out = StringIO()
+        call_command('backfill_thumbnails', '--workers=1', stdout=out)
+        self.assertIn('картинок 0 ', out.getvalue())
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+    def test_backfill_thumbnails_force(self):
+        """с --force готовые превью пересоздаются заново"""
+        post = Post.objects.create(
+            author=self.author,
+            text='Пост для пересоздания превью',
+            image=small_gif('force.gif', b'\x0f'),
+        )
+        call_command('backfill_thumbnails', '--workers=1', stdout=StringIO())
+        paths = [
+            thumbnail.storage.path(thumbnail.name)
+            for variants in card_variants(post.image).values()
+            for _, thumbnail in variants
+        ]
+        self.assertEqual(len(paths), len(GEOMETRIES))
+        for path in paths:
+            os.utime(path, (0, 0))
+        out = StringIO()
+        call_command(
+            'backfill_thumbnails', '--workers=1', '--force', stdout=out)
+        self.assertIn('картинок 1 ', out.getvalue())
+        for path in paths:
+            self.assertGreater(os.path.getmtime(path), 0)
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+    def test_backfill_thumbnails_pool(self):
+        """команда готовит превью и в пуле процессов"""
+        for delay in (b'\x10', b'\x11'):
+            Post.objects.create(
+                author=self.author,
+                text='Пост для пула',
+                image=small_gif('pool.gif', delay),
+            )
+        out = StringIO()
+        # Соединение с базой закрывается перед каждой пачкой: процессы
+        # пула создаются при map(), уже после запросов этой пачки.
+        with mock.patch(
+                'posts.management.commands.backfill_thumbnails.connections'
+                '.close_all', wraps=connections.close_all) as close_all:
+            call_command(
+                'backfill_thumbnails', '--workers=2', '--batch=1',
+                stdout=out)
+        self.assertEqual(close_all.call_count, 2)
+        self.assertIn('картинок 2 ', out.getvalue())
+        self.assertIn('ошибок 0.', out.getvalue())
+        names = Post.objects.filter(text='Пост для пула').values_list(
+            'image', flat=True)
+        self.assertEqual(missing(list(names)), [])
+
+    def make_image_post(self, color):
+        buffer = BytesIO()
+        Image.new('RGB', (40, 30), color).save(buffer, 'JPEG')
+        return Post.objects.create(
+            author=self.author,
+            text=f'Пост с картинкой {color}',
+            image=SimpleUploadedFile(
+                f'{color}.jpg', buffer.getvalue(), 'image/jpeg'),
+        )
+
+    @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_INLINE_BUDGET=5)
+    def test_inline_thumbnail(self):
+        """небольшое превью готовится при рендеринге в пределах бюджета"""
+        breaker.reset()
+        reset_inline_stats()
+        self.make_image_post('orange')
+        response = self.authorized_client.get(reverse('posts:index'))
+        self.assertNotContains(response, 'Картинка готовится')
+        self.assertContains(response, '.jpg')
+        self.assertEqual(inline_stats()['generated'], 1)
+        # Остальные варианты всё равно готовит очередь.
+        self.assertTrue(ThumbnailJob.objects.exists())
+
+    @override_settings(
+        MEDIA_ROOT=TEMP_MEDIA_ROOT,
+        THUMBNAIL_INLINE_BUDGET=5,
+        THUMBNAIL_INLINE_SLOW=0,
+        THUMBNAIL_BREAKER_THRESHOLD=1,
+    )
+    def test_inline_thumbnail_breaker(self):
+        """после медленных генераций предохранитель включает заглушки"""
+        breaker.reset()
+        reset_inline_stats()
+        self.make_image_post('purple')
+        self.make_image_post('olive')
+        response = self.authorized_client.get(reverse('posts:index'))
+        self.assertContains(response, 'Картинка готовится', count=1)
+        stats = inline_stats()
+        self.assertEqual(stats['generated'], 1)
+        self.assertEqual(stats['slow'], 1)
+        self.assertEqual(stats['breaker_open'], 1)
+        breaker.reset()
+
+    @override_settings(
+        MEDIA_ROOT=TEMP_MEDIA_ROOT, THUMBNAIL_INLINE_BUDGET=0.05)
+    def test_inline_thumbnail_timeout(self):
+        """запрос не ждёт превью дольше бюджета"""
+        breaker.reset()
+        reset_inline_stats()
+        self.make_image_post('teal')
+        release = threading.Event()
+
+        def stuck(*args, **kwargs):
+            release.wait(5)
+            raise OSError('превью не готово')
+
+        with mock.patch('posts.thumbnails.get_thumbnail', side_effect=stuck):
+            started = time.monotonic()
+            response = self.authorized_client.get(reverse('posts:index'))
+            elapsed = time.monotonic() - started
+            release.set()
+        self.assertLess(elapsed, 2)
+        self.assertContains(response, 'Картинка готовится')
+        self.assertEqual(inline_stats()['timeout'], 1)
+        breaker.reset()
+
+    def test_numbered_paginator_is_windowed(self):
+        """навигация по номерам показывает только окно страниц"""
+        Post.objects.bulk_create(
+            Post(author=self.author, text=f'Пост {number}')
+            for number in range(60)
+        )
+        # bulk_create идёт в обход сигналов, кэш сбрасываем сами.
+        cache.clear()
+        with mock.patch('posts.helpers.POSTS_PER_PAGE', 1):
+            response = self.authorized_client.get(
+                reverse('posts:index'), {'page': 30})
+        page_obj = response.context['page_obj']
+        self.assertIs(type(page_obj), Page)
+        last = page_obj.paginator.num_pages
+        self.assertEqual(
+            page_obj.elided_page_range,
+            [1, None, 28, 29, 30, 31, 32, None, last])
+        self.assertContains(response, '&hellip;', count=2)
+        self.assertContains(response, f'page={last}"', count=2)
+        self.assertNotContains(response, 'page=10"')
+
+    def test_pagination_modes_cached_apart(self):
+        """первая курсорная страница и ?page=1 кэшируются отдельно"""
+        Post.objects.bulk_create(
+            Post(author=self.author, text=f'Пост {number}')
+            for number in range(14)
+        )
+        cache.clear()
+        url = reverse('posts:index')
+        self.assertNotContains(self.authorized_client.get(url), 'page=2"')
+        response = self.authorized_client.get(url, {'page': 1})
+        self.assertContains(response, 'page=2"')
+        response = self.authorized_client.get(url)
+        self.assertNotContains(response, 'page=2"')
+
+    def test_numbered_paginator_count_cached(self):
+        """число постов для пагинатора берётся из кэша до новой записи"""
+        cache.clear()
+        url = reverse('posts:index')
+        self.authorized_client.get(url, {'page': 1})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.authorized_client.get(url, {'page': 1})
+        self.assertFalse(any(
+            'COUNT(' in query['sql'] for query in queries.captured_queries))
+        count = response.context['page_obj'].paginator.count
+        self.new_post_creation()
+        response = self.authorized_client.get(url, {'page': 1})
+        self.assertEqual(
+            response.context['page_obj'].paginator.count, count + 1)
+
+    @override_settings(PAGINATOR_ESTIMATE_THRESHOLD=1)
+    def test_numbered_paginator_count_estimated(self):
+        """большая общая лента оценивает число постов по pk"""
+        cache.clear()
+        post = self.new_post_creation()
+        Post.objects.filter(pk=post.pk - 1).delete()
+        response = self.authorized_client.get(
+            reverse('posts:index'), {'page': 1})
+        self.assertEqual(response.context['page_obj'].paginator.count, post.pk)
@@ -0,0 +1,406 @@
+"""Превью картинок постов.
+
+Превью всех размеров, которые используют шаблоны, готовятся фоновым
+обработчиком (manage.py thumbnail_worker) сразу после загрузки. При
+рендеринге превью только ищется в KV-хранилище sorl-thumbnail; если его
+ещё нет, шаблон показывает заглушку, а картинка ставится в очередь.
+
+Небольшие картинки можно не ждать: одно запасное превью готовится прямо
+при рендеринге, но не дольше бюджета времени на запрос
+(THUMBNAIL_INLINE_BUDGET). Если генерация раз за разом оказывается
+медленной, размыкается предохранитель, и до конца паузы все картинки
+снова идут только через очередь.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from django.core.cache import cache
+from django.db.models import F
+from sorl.thumbnail import default, get_thumbnail
+from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.conf import defaults as default_settings
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.images import ImageFile
+
+from .cache import bump_generations, post_scope, post_scopes
+from .images import CARD_RATIO, complete_metadata
+from .models import Post, ThumbnailJob, new_etag
+
+
+logger = logging.getLogger(__name__)
+
+# Карточка поста отдается набором ширин в WebP и JPEG (для браузеров
+# без WebP), браузер выбирает вариант по srcset/sizes.
+CARD_WIDTHS = (320, 640, 960)
+CARD_SIZES = '(max-width: 960px) 100vw, 960px'
+FORMATS = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg'}
+
+# Все превью, которые используют шаблоны: имя -> (геометрия, опции).
+GEOMETRIES = {
+    f'card_{width}_{image_format.lower()}': (
+        f'{width}x{round(width * CARD_RATIO)}',
+        {'crop': 'center', 'upscale': True, 'format': image_format},
+    )
+    for width in CARD_WIDTHS
+    for image_format in FORMATS
+}
+
+# Превью, которое готовится при рендеринге, если его ещё нет.
+INLINE_ALIAS = 'card_960_jpeg'
+INLINE_COUNTERS = (
+    'generated', 'slow', 'failed', 'timeout', 'deferred', 'breaker_open')
+# Превью при рендеринге готовится в отдельном потоке, чтобы запрос мог
+# перестать его ждать, когда кончится бюджет.
+INLINE_WORKERS = 2
+DEFAULT_INLINE_BUDGET = 0
+DEFAULT_INLINE_SLOW = 0.1
+DEFAULT_INLINE_MAX_PIXELS = 4_000_000
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30
+DEFAULT_MAX_ATTEMPTS = 3
+# Сколько процесс помнит, что картинка уже в очереди, и не повторяет
+# INSERT при каждом рендеринге страницы с ней.
+QUEUED_TIMEOUT = 60 * 60
+
+
+def _setting(name, default_value):
+    return getattr(settings, name, default_value)
+
+
+class ThumbnailError(Exception):
+    """Превью не удалось подготовить."""
+
+
+class PostThumbnailBackend(ThumbnailBackend):
+    """Бэкенд sorl-thumbnail, умеющий искать превью без генерации."""
+
+    def get_options(self, source, options):
+        """Опции превью с умолчаниями — так же, как в get_thumbnail()."""
+        options = dict(options)
+        if settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault('format', self._get_format(source))
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(settings, attr)
+            if value != getattr(default_settings, attr):
+                options.setdefault(key, value)
+        return options
+
+    def get_thumbnail_file(self, file_, geometry_string, **options):
+        """Файл превью (без проверки, готово ли оно)."""
+        source = ImageFile(file_)
+        name = self._get_thumbnail_filename(
+            source, geometry_string, self.get_options(source, options))
+        return ImageFile(name, default.storage)
+
+
+def _queued_key(name):
+    return f'thumbnails:queued:{name}'
+
+
+def enqueue(*names):
+    """Ставит картинки в очередь на подготовку превью.
+
+    Картинки, которые недавно уже ставились в очередь (в том числе
+    неудачные задания), пропускаются без запроса к базе.
+    """
+    keys = {_queued_key(name): name for name in names if name}
+    queued = cache.get_many(list(keys))
+    new = {key: name for key, name in keys.items() if key not in queued}
+    if not new:
+        return
+    ThumbnailJob.objects.bulk_create(
+        [ThumbnailJob(image=name) for name in new.values()],
+        ignore_conflicts=True,
+    )
+    cache.set_many(dict.fromkeys(new, True), QUEUED_TIMEOUT)
+
+
+def dequeue(*names):
+    """Убирает из очереди картинки, превью которых готовы."""
+    ThumbnailJob.objects.filter(image__in=names).delete()
+    cache.delete_many([_queued_key(name) for name in names])
+
+
+def forget(name):
+    """Удаляет готовые превью картинки: файлы и записи в KV-хранилище."""
+    source = ImageFile(name, Post.image.field.storage)
+    default.kvstore.delete_thumbnails(source)
+    # Превью, которых нет в списке у исходника (например, записанные
+    # прерванным запуском), удаляются по именам.
+    for geometry, options in GEOMETRIES.values():
+        thumbnail = default.backend.get_thumbnail_file(
+            source, geometry, **options)
+        default.kvstore.delete(thumbnail, delete_thumbnails=False)
+        if thumbnail.exists():
+            thumbnail.delete()
+
+
+def generate(name, force=False):
+    """Готовит все превью картинки; ThumbnailError, если что-то не вышло.
+
+    get_thumbnail() не трогает превью, которое уже есть в KV-хранилище
+    или на диске, поэтому с force=True готовые превью сначала удаляются.
+    """
+    # Ключ превью в sorl зависит от хранилища исходника, поэтому файл
+    # открывается через хранилище поля, как и в шаблонах.
+    source = ImageFile(name, Post.image.field.storage)
+    if force:
+        forget(name)
+    for geometry, options in GEOMETRIES.values():
+        get_thumbnail(source, geometry, **options)
+    # get_thumbnail не бросает исключений, если исходник не читается, а
+    # просто не записывает превью в KV-хранилище.
+    if missing([name]):
+        raise ThumbnailError(f'Не все превью готовы: {name}')
+    complete_metadata(name)
+
+
+def try_generate(name, force=False):
+    """Как generate(), но ошибка только пишется в лог; True, если успешно."""
+    try:
+        generate(name, force)
+    except Exception:
+        logger.exception('Не удалось подготовить превью %s', name)
+        return False
+    return True
+
+
+def missing(names):
+    """Те картинки из списка, у которых готовы не все превью."""
+    storage = Post.image.field.storage
+    cards = {
+        name: [
+            default.backend.get_thumbnail_file(
+                ImageFile(name, storage), geometry, **options)
+            for geometry, options in GEOMETRIES.values()
+        ]
+        for name in names
+    }
+    found = cached_thumbnails([
+        thumbnail for card in cards.values() for thumbnail in card])
+    return [
+        name for name, card in cards.items()
+        if any(thumbnail.key not in found for thumbnail in card)
+    ]
+
+
+def refresh_pages(name):
+    """Сбрасывает кэш страниц и карточек постов с этой картинкой."""
+    posts = Post.objects.filter(image=name)
+    scopes = []
+    for post in posts.only('author', 'group'):
+        scopes.extend([post_scope(post.pk), *post_scopes(post)])
+    # Карточки с заглушкой вместо готовых превью больше не годятся.
+    posts.update(etag=new_etag())
+    bump_generations(*scopes)
+
+
+def cached_thumbnails(thumbnails):
+    """Готовые превью одним запросом к KV-хранилищу: {ключ: превью}."""
+    get_many = getattr(default.kvstore, 'get_many', None)
+    if get_many is not None:
+        return get_many(thumbnails)
+    found = {}
+    for thumbnail in thumbnails:
+        cached = default.kvstore.get(thumbnail)
+        if cached is not None:
+            found[thumbnail.key] = cached
+    return found
+
+
+def prefetch_card_variants(images):
+    """Варианты карточек сразу для нескольких картинок: {имя: варианты}.
+
+    Все превью ищутся в KV-хранилище одним запросом; картинки, у которых
+    готово не всё, ставятся в очередь тоже одним запросом.
+    """
+    cards = {}
+    for image in images:
+        if not image or image.name in cards:
+            continue
+        cards[image.name] = card = []
+        for image_format, mime_type in FORMATS.items():
+            for width in CARD_WIDTHS:
+                geometry, options = GEOMETRIES[
+                    f'card_{width}_{image_format.lower()}']
+                card.append((
+                    mime_type, width, default.backend.get_thumbnail_file(
+                        image, geometry, **options),
+                ))
+    found = cached_thumbnails([
+        thumbnail for card in cards.values() for _, _, thumbnail in card])
+    variants = {}
+    missing = []
+    for name, card in cards.items():
+        variants[name] = {}
+        for mime_type, width, thumbnail in card:
+            thumbnail = found.get(thumbnail.key)
+            if thumbnail is None:
+                missing.append(name)
+            else:
+                variants[name].setdefault(mime_type, []).append(
+                    (width, thumbnail))
+    enqueue(*dict.fromkeys(missing))
+    return variants
+
+
+def card_variants(image):
+    """Готовые варианты карточки: {mime-тип: [(ширина, превью), ...]}.
+
+    Если не готов ни один вариант, возвращает пустой словарь.
+    """
+    return prefetch_card_variants([image]).get(image.name, {})
+
+
+class CircuitBreaker:
+    """Предохранитель: размыкается после threshold неудач подряд.
+
+    Пока он разомкнут, allow() возвращает False; после паузы пропускает
+    одну пробную попытку, и её результат решает, замкнуться ли снова.
+    Порог и пауза читаются из настроек при каждом вызове.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def threshold(self):
+        return _setting(
+            'THUMBNAIL_BREAKER_THRESHOLD', DEFAULT_BREAKER_THRESHOLD)
+
+    @property
+    def cooldown(self):
+        return _setting('THUMBNAIL_BREAKER_COOLDOWN', DEFAULT_BREAKER_COOLDOWN)
+
+    def reset(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            # Пробная попытка; остальные ждут её результата.
+            self.opened_at = time.monotonic()
+            return True
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.reset()
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker()
+inline_executor = ThreadPoolExecutor(
+    INLINE_WORKERS, thread_name_prefix='inline-thumbnail')
+
+
+def _count(name):
+    key = f'thumbnails:inline:{name}'
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def inline_stats():
+    """Счётчики генерации превью при рендеринге."""
+    keys = {f'thumbnails:inline:{name}': name for name in INLINE_COUNTERS}
+    values = cache.get_many(list(keys))
+    return {name: values.get(key, 0) for key, name in keys.items()}
+
+
+def reset_inline_stats():
+    cache.delete_many(
+        [f'thumbnails:inline:{name}' for name in INLINE_COUNTERS])
+
+
+def _remaining_budget(request):
+    if request is None:
+        return 0
+    deadline = getattr(request, '_thumbnail_deadline', None)
+    if deadline is None:
+        deadline = time.monotonic() + _setting(
+            'THUMBNAIL_INLINE_BUDGET', DEFAULT_INLINE_BUDGET)
+        request._thumbnail_deadline = deadline
+    return deadline - time.monotonic()
+
+
+def inline_variants(image, request):
+    """Готовит запасное превью при рендеринге, если хватает бюджета.
+
+    Возвращает варианты карточки (только JPEG) или пустой словарь —
+    тогда шаблон показывает заглушку, а превью готовит очередь.
+    """
+    post = image.instance
+    pixels = (post.image_width or 0) * (post.image_height or 0)
+    remaining = _remaining_budget(request)
+    if (remaining <= 0 or not pixels
+            or pixels > _setting('THUMBNAIL_INLINE_MAX_PIXELS',
+                                 DEFAULT_INLINE_MAX_PIXELS)):
+        _count('deferred')
+        return {}
+    if not breaker.allow():
+        _count('breaker_open')
+        return {}
+    geometry, options = GEOMETRIES[INLINE_ALIAS]
+    started = time.monotonic()
+    future = inline_executor.submit(get_thumbnail, image, geometry, **options)
+    try:
+        thumbnail = future.result(timeout=remaining)
+    except FutureTimeout:
+        # Поток нельзя прервать: превью допишется в фоне и пригодится
+        # следующему запросу, а этот покажет заглушку.
+        future.cancel()
+        breaker.record(False)
+        _count('timeout')
+        return {}
+    except Exception:
+        logger.exception('Не удалось подготовить превью %s', image.name)
+        breaker.record(False)
+        _count('failed')
+        return {}
+    slow = time.monotonic() - started > _setting(
+        'THUMBNAIL_INLINE_SLOW', DEFAULT_INLINE_SLOW)
+    breaker.record(not slow)
+    _count('generated')
+    if slow:
+        _count('slow')
+    return {FORMATS['JPEG']: [(CARD_WIDTHS[-1], thumbnail)]}
+
+
+def process_jobs(limit=None):
+    """Обрабатывает очередь; возвращает (готово, не удалось).
+
+    Неудачное задание остаётся в очереди со счётчиком попыток и берётся
+    снова позже новых, пока попытки не кончатся.
+    """
+    jobs = ThumbnailJob.objects.filter(
+        attempts__lt=_setting('THUMBNAIL_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS),
+    ).order_by('attempts', 'pk')
+    if limit is not None:
+        jobs = jobs[:limit]
+    done = failed = 0
+    for job in list(jobs):
+        if not try_generate(job.image):
+            ThumbnailJob.objects.filter(pk=job.pk).update(
+                attempts=F('attempts') + 1)
+            failed += 1
+            continue
+        dequeue(job.image)
+        refresh_pages(job.image)
+        done += 1
+    return done, failed
@@ -0,0 +1,61 @@
+"""Материализованная лента подписок.
+
+Каждый пост при публикации раскладывается по лентам подписчиков автора,
+поэтому страница /follow/ читается одним диапазоном по индексу
+(user, pub_date, post) без join с Follow.
+"""
+from itertools import islice
+
+from .helpers import page_paginator
+from .models import Follow, Post, TimelineEntry
+
+
+TIMELINE_ORDERING = ('-pub_date', '-post_id')
+BATCH_SIZE = 500
+
+
+def _bulk_insert(entries):
+    entries = iter(entries)
+    while True:
+        batch = list(islice(entries, BATCH_SIZE))
+        if not batch:
+            break
+        TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def fan_out(post):
+    """Добавляет новый пост в ленты всех подписчиков автора."""
+    followers = Follow.objects.filter(
+        author_id=post.author_id).values_list('user_id', flat=True)
+    _bulk_insert(
+        TimelineEntry(user_id=user_id, post=post, pub_date=post.pub_date)
+        for user_id in followers.iterator()
+    )
+
+
+def backfill(follow):
+    """Заполняет ленту подписчика уже опубликованными постами автора."""
+    posts = Post.objects.filter(
+        author_id=follow.author_id).values_list('pk', 'pub_date')
+    _bulk_insert(
+        TimelineEntry(user_id=follow.user_id, post_id=pk, pub_date=pub_date)
+        for pk, pub_date in posts.iterator()
+    )
+
+
+def trim(follow):
+    """Убирает из ленты подписчика посты автора, от которого он отписался."""
+    TimelineEntry.objects.filter(
+        user_id=follow.user_id,
+        post__author_id=follow.author_id,
+    ).delete()
+
+
+def timeline_page(user, request):
+    """Страница ленты подписок с постами вместо записей ленты."""
+    page_obj = page_paginator(
+        user.timeline.all(), request, ordering=TIMELINE_ORDERING)
+    post_ids = [entry.post_id for entry in page_obj.object_list]
+    posts = Post.objects.for_feed().in_bulk(post_ids)
+    page_obj.object_list = [posts[pk] for pk in post_ids if pk in posts]
+    return page_obj
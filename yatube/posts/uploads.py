@@ -0,0 +1,198 @@
+"""Приём картинок с ограниченным расходом памяти.
+
+Загрузки всегда пишутся на диск кусками (BoundedUploadHandler) и
+обрезаются после лимита по размеру. Картинка проверяется по заголовку:
+размер в пикселях известен до декодирования, поэтому «бомбы» отсекаются
+без распаковки. Метаданные (EXIF, комментарии, текстовые чанки PNG)
+вырезаются потоковым копированием сегментов файла, тоже без декодирования.
+"""
+import struct
+import tempfile
+from io import BytesIO
+
+from django import forms
+from django.conf import settings
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.template.defaultfilters import filesizeformat
+from PIL import Image
+
+
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_MAX_PIXELS = 40_000_000
+COPY_CHUNK = 64 * 1024
+ORIENTATION_TAG = 0x0112
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_SOS = 0xDA
+JPEG_COM = 0xFE
+JPEG_APP1 = 0xE1
+JPEG_APP15 = 0xEF
+# Сегменты, которые влияют на цвет: их оставляем.
+JPEG_KEEP_PREFIXES = (b'ICC_PROFILE', b'Adobe')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_DROP_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'tIME'}
+
+
+def max_bytes():
+    return getattr(settings, 'POST_IMAGE_MAX_BYTES', DEFAULT_MAX_BYTES)
+
+
+def max_pixels():
+    return getattr(settings, 'POST_IMAGE_MAX_PIXELS', DEFAULT_MAX_PIXELS)
+
+
+class BoundedUploadHandler(TemporaryFileUploadHandler):
+    """Пишет загрузку во временный файл, но не больше лимита.
+
+    Всё, что сверх лимита, отбрасывается; размер файла остаётся
+    настоящим, и форма отклоняет его по размеру.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.written = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        room = max_bytes() + 1 - self.written
+        if room > 0:
+            self.file.write(raw_data[:room])
+            self.written += min(room, len(raw_data))
+
+
+def _copy(source, destination, length=None):
+    while length is None or length > 0:
+        size = COPY_CHUNK if length is None else min(COPY_CHUNK, length)
+        chunk = source.read(size)
+        if not chunk:
+            break
+        destination.write(chunk)
+        if length is not None:
+            length -= len(chunk)
+
+
+def _orientation_exif(payload):
+    """Минимальный EXIF только с ориентацией (или None, если она обычная)."""
+    exif = Image.Exif()
+    try:
+        exif.load(payload)
+    except Exception:
+        return None
+    orientation = exif.get(ORIENTATION_TAG)
+    if orientation in (None, 1):
+        return None
+    minimal = Image.Exif()
+    minimal[ORIENTATION_TAG] = orientation
+    return minimal.tobytes()
+
+
+def _strip_jpeg(source, destination):
+    destination.write(source.read(2))
+    while True:
+        marker = source.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError('Повреждённый JPEG')
+        code = marker[1]
+        while code == 0xFF:
+            code = source.read(1)[0]
+            marker = b'\xff' + bytes([code])
+        if code == JPEG_SOS:
+            destination.write(marker)
+            _copy(source, destination)
+            return
+        if 0xD0 <= code <= 0xD7 or code == 0x01:
+            destination.write(marker)
+            continue
+        length = struct.unpack('>H', source.read(2))[0]
+        payload = source.read(length - 2)
+        if code == JPEG_APP1 and payload.startswith(b'Exif'):
+            exif = _orientation_exif(payload)
+            if exif is not None:
+                destination.write(marker + struct.pack('>H', len(exif) + 2))
+                destination.write(exif)
+            continue
+        if ((JPEG_APP1 <= code <= JPEG_APP15 or code == JPEG_COM)
+                and not payload.startswith(JPEG_KEEP_PREFIXES)):
+            continue
+        destination.write(marker + struct.pack('>H', length) + payload)
+
+
+def _strip_png(source, destination):
+    destination.write(source.read(len(PNG_SIGNATURE)))
+    while True:
+        header = source.read(8)
+        if not header:
+            return
+        if len(header) < 8:
+            raise ValueError('Повреждённый PNG')
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type in PNG_DROP_CHUNKS:
+            source.seek(length + 4, 1)
+            continue
+        destination.write(header)
+        _copy(source, destination, length + 4)
+
+
+def strip_metadata(source, destination):
+    """Копирует картинку без метаданных; False, если формат не поддержан."""
+    start = source.read(len(PNG_SIGNATURE))
+    source.seek(0)
+    if start.startswith(JPEG_SOI):
+        _strip_jpeg(source, destination)
+    elif start == PNG_SIGNATURE:
+        _strip_png(source, destination)
+    else:
+        return False
+    return True
+
+
+def check_size(data):
+    """Проверяет загруженный файл по лимиту байт.
+
+    Файл сверх лимита обрезан при приёме, поэтому проверять его нужно
+    раньше, чем ImageField попробует разобрать картинку.
+    """
+    if data.size > max_bytes():
+        raise forms.ValidationError(
+            'Файл слишком большой: максимум %s.'
+            % filesizeformat(max_bytes()),
+            code='file_too_large',
+        )
+
+
+def check_image(data):
+    """Проверяет загруженную картинку по лимитам байт и пикселей.
+
+    Вызывается после ImageField.to_python: тот уже разобрал заголовок
+    (data.image), сами пиксели при этом не декодировались.
+    """
+    check_size(data)
+    width, height = data.image.size
+    if width * height > max_pixels():
+        raise forms.ValidationError(
+            'Картинка слишком большая: не больше %s пикселей.'
+            % max_pixels(),
+            code='too_many_pixels',
+        )
+
+
+def strip_upload(data):
+    """Заменяет содержимое загруженного файла копией без метаданных."""
+    data.seek(0)
+    if hasattr(data, 'temporary_file_path'):
+        stripped = tempfile.NamedTemporaryFile(
+            suffix='.upload', dir=settings.FILE_UPLOAD_TEMP_DIR)
+    else:
+        stripped = BytesIO()
+    try:
+        rewritten = strip_metadata(data.file, stripped)
+    except (ValueError, IndexError, struct.error):
+        rewritten = False
+    if not rewritten:
+        stripped.close()
+        data.seek(0)
+        return
+    data.file.close()
+    data.file = stripped
+    data.size = stripped.seek(0, 2)
+    stripped.seek(0)
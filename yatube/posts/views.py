@@ -1,66 +1,133 @@
+from functools import partial
+from urllib.parse import urlencode
+
+from django.core.paginator import Paginator
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
 
+from .cache import (
+    GLOBAL_SCOPE, author_scope, cache_page_for_anonymous, depend_on,
+    depend_on_comments, depend_on_posts, feed_cache_context, group_scope,
+    post_scope, user_scope
+)
+from .counters import feed_count, get_stats
 from .forms import PostForm, CommentForm
 from .models import Post, Group, Follow
-from .helpers import page_paginator
+from .helpers import (
+    COMMENTS_CURSOR_PARAM, CURSOR_PARAM, POSTS_PER_PAGE, comments_page,
+    numbered_page, page_paginator
+)
+from .search import SearchResults
+from .thumbnails import enqueue
+from .timeline import timeline_page
 
 
 PAGE_TITLE_LEN = 30
 User = get_user_model()
 
 
+@cache_page_for_anonymous
 def index(request):
-    post_list = Post.objects.all()
+    depend_on(request, GLOBAL_SCOPE)
+    post_list = Post.objects.for_feed()
     context = {
-        'page_obj': page_paginator(post_list, request),
+        **feed_cache_context(GLOBAL_SCOPE),
+        'page_obj': page_paginator(
+            post_list, request,
+            count=partial(feed_count, post_list, GLOBAL_SCOPE)),
     }
+    depend_on_posts(request, context['page_obj'])
     return render(request, 'posts/index.html', context)
 
 
+@cache_page_for_anonymous
 def group_posts(request, group_condition):
     group = get_object_or_404(Group, slug=group_condition)
-    post_list = group.posts.all()
+    depend_on(request, group_scope(group.pk))
+    post_list = group.posts.for_feed()
     context = {
+        **feed_cache_context(group_scope(group.pk)),
         'group': group,
-        'page_obj': page_paginator(post_list, request),
+        'page_obj': page_paginator(
+            post_list, request,
+            count=partial(feed_count, post_list, group_scope(group.pk))),
     }
     return render(request, 'posts/group_list.html', context)
 
 
+@cache_page_for_anonymous
 def profile(request, username):
-    author = get_object_or_404(User, username=username)
-    post_list = author.posts.all()
+    author = get_object_or_404(
+        User.objects.select_related('stats'), username=username)
+    depend_on(request, author_scope(author.pk), user_scope(author.pk))
+    stats = get_stats(author)
+    post_list = author.posts.for_feed()
     following = request.user.is_authenticated and (
         Follow.objects.filter(
             user=request.user, author=author).exists())
     context = {
+        **feed_cache_context(author_scope(author.pk)),
         'author': author,
-        'posts_count': author.posts.count(),
-        'page_obj': page_paginator(post_list, request),
+        'stats': stats,
+        'posts_count': stats.posts_count,
+        # Счётчик постов в профиле уже поддерживается сигналами.
+        'page_obj': page_paginator(
+            post_list, request, count=lambda: stats.posts_count),
         'following': following,
     }
+    depend_on_posts(request, context['page_obj'])
     return render(request, 'posts/profile.html', context)
 
 
+@cache_page_for_anonymous
 def post_detail(request, post_id):
-    post = get_object_or_404(Post, pk=post_id)
+    post = get_object_or_404(
+        Post.objects.select_related('author__stats', 'group'), pk=post_id)
+    depend_on(request, post_scope(post.pk), author_scope(post.author_id))
+    depend_on_posts(request, [post])
     page_title = 'Пост ' + post.text[0:PAGE_TITLE_LEN]
     comment_form = CommentForm()
-    author_post_number = post.author.posts.count()
-    comments_list = post.comments.all()
+    author_post_number = get_stats(post.author).posts_count
+    comments = comments_page(
+        post, request.GET.get(COMMENTS_CURSOR_PARAM, ''))
+    depend_on_comments(request, comments)
     context = {
         'page_title': page_title,
         'post': post,
         'author_post_number': author_post_number,
         'comment_form': comment_form,
-        'comments': comments_list,
+        'comments': comments,
         'user': request.user,
     }
     return render(request, 'posts/post_detail.html', context)
 
 
+@cache_page_for_anonymous
+def post_comments(request, post_id):
+    """Следующая пачка комментариев фрагментом HTML для подгрузки."""
+    post = get_object_or_404(Post.objects.only('pk'), pk=post_id)
+    depend_on(request, post_scope(post.pk))
+    comments = comments_page(post, request.GET.get(CURSOR_PARAM, ''))
+    depend_on_comments(request, comments)
+    context = {
+        'post': post,
+        'comments': comments,
+    }
+    return render(request, 'includes/comment_list.html', context)
+
+
+def search_posts(request):
+    query = request.GET.get('q', '').strip()
+    paginator = Paginator(SearchResults(query), POSTS_PER_PAGE)
+    context = {
+        'query': query,
+        'query_prefix': urlencode({'q': query}) + '&',
+        'page_obj': numbered_page(paginator, request.GET.get('page')),
+    }
+    return render(request, 'posts/search.html', context)
+
+
 @login_required
 def add_comment(request, post_id):
     form = CommentForm(request.POST or None)
@@ -81,6 +148,8 @@ def post_create(request):
         author = request.user
         post.author = author
         post.save()
+        if post.image:
+            enqueue(post.image.name)
         return redirect('posts:profile', author.username)
     context = {
         'form': form,
@@ -102,6 +171,8 @@ def post_edit(request, post_id):
         )
         if form.is_valid():
             form.save()
+            if post.image and 'image' in form.changed_data:
+                enqueue(post.image.name)
             return redirect('posts:post_detail', post.pk)
         return render(request, 'posts/create.html', {'form': form})
     form = PostForm(instance=post)
@@ -115,9 +186,8 @@ def post_edit(request, post_id):
 
 @login_required
 def follow_index(request):
-    post_list = Post.objects.filter(author__following__user=request.user)
     context = {
-        'page_obj': page_paginator(post_list, request),
+        'page_obj': timeline_page(request.user, request),
     }
     return render(request, 'posts/follow.html', context)
 
@@ -42,12 +42,22 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'yatube.urls'
 
+# Вне DEBUG шаблоны компилируются один раз на процесс: без кэша каждый
+# include и inclusion-тег заново читает и разбирает файл.
+BASE_TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
-        'APP_DIRS': True,
         'OPTIONS': {
+            'loaders': BASE_TEMPLATE_LOADERS if DEBUG else [
+                ('django.template.loaders.cached.Loader',
+                 BASE_TEMPLATE_LOADERS),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -109,8 +119,50 @@ MEDIA_URL = '/media/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Как отдавать медиафайлы: 'x-accel-redirect' (nginx, с internal-локацией
+# MEDIA_ACCEL_PREFIX, смотрящей в MEDIA_ROOT), 'x-sendfile' (Apache,
+# lighttpd) или None — сам Django через FileResponse.
+MEDIA_SERVE_MODE = None
+
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# Подкаталоги MEDIA_ROOT, которые можно отдавать наружу.
+MEDIA_PUBLIC_PREFIXES = ['posts/', 'cache/']
+
+# Загрузки всегда пишутся на диск кусками, а не собираются в памяти.
+FILE_UPLOAD_HANDLERS = ['posts.uploads.BoundedUploadHandler']
+
+POST_IMAGE_MAX_BYTES = 5 * 1024 * 1024
+
+POST_IMAGE_MAX_PIXELS = 40_000_000
+
+# Картинки крупнее (PNG и GIF; JPEG уменьшается ещё при чтении) при
+# загрузке не декодируются: цвет и заглушку для них считает фоновый
+# обработчик превью.
+POST_IMAGE_SAMPLE_MAX_PIXELS = 4_000_000
+
+# Начиная с такого числа постов общая лента при листании по номерам
+# оценивает число постов по максимальному pk вместо COUNT(*).
+PAGINATOR_ESTIMATE_THRESHOLD = 100_000
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
+
+THUMBNAIL_BACKEND = 'posts.thumbnails.PostThumbnailBackend'
+
+# Сколько секунд за запрос можно потратить на превью, которых ещё нет;
+# остальные картинки показываются заглушкой и готовятся в очереди.
+THUMBNAIL_INLINE_BUDGET = 0.2
+
+# Столько раз фоновый обработчик пробует подготовить превью картинки,
+# прежде чем оставить её с заглушкой.
+THUMBNAIL_MAX_ATTEMPTS = 3
+
+# Метаданные превью хранятся в локальном SQLite (MEDIA_ROOT/cache) с LRU
+# в памяти процесса, а не в основной базе.
+THUMBNAIL_KVSTORE = 'posts.kvstore.KVStore'
+
+THUMBNAIL_KVSTORE_LRU_SIZE = 4096
@@ -1,21 +1,18 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
+
+from core.views import media
 
 
 handler404 = 'core.views.page_not_found'
 handler500 = 'core.views.server_failure'
 handler403 = 'core.views.csrf_failure'
 urlpatterns = [
+    path(f'{settings.MEDIA_URL.lstrip("/")}<path:path>', media, name='media'),
     path('about/', include('about.urls', namespace='about')),
     path('', include('posts.urls', namespace='posts')),
     path('admin/', admin.site.urls),
     path('auth/', include('users.urls', namespace='users')),
     path('auth/', include('django.contrib.auth.urls')),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(
-        settings.MEDIA_URL, document_root=settings.MEDIA_ROOT
-    )